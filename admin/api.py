@@ -2,26 +2,74 @@ from sanic import Blueprint, Request, response
 from sanic_openapi.openapi3 import openapi
 from sanic_validation import validate_json
 
-from admin.json_responses import (ProductCreateResponse201,
+from admin.json_responses import (MetricsResponse200, ProductCreateResponse201,
                                   ProductDeleteResponse200,
+                                  ProductsBulkResponse200,
                                   ProductsRetrieveResponse200,
                                   ProductUpdateResponse200,
                                   UserPatchResponse200, UsersGetResponse200)
 from admin.json_validators import (ProductCreateRequestBody,
                                    ProductDeleteRequestBody,
+                                   ProductsBulkCreateRequestBody,
+                                   ProductsBulkDeleteRequestBody,
+                                   ProductsBulkUpdateRequestBody,
                                    ProductUpdateRequestBody,
                                    UserPatchRequestBody, product_create_schema,
                                    product_delete_schema,
-                                   product_update_schema, user_patch_schema)
-from products.utils import (create_product, delete_product, get_all_products,
+                                   product_update_schema,
+                                   products_bulk_create_schema,
+                                   products_bulk_delete_schema,
+                                   products_bulk_update_schema,
+                                   user_patch_schema)
+from compression import encode_cached
+from metrics import collect_metrics
+from products.utils import (bulk_create_products, bulk_delete_products,
+                            bulk_update_products, catalog, create_product,
+                            delete_product, get_products_page,
+                            invalidate_catalog, parse_page_args,
                             update_product)
-from users.auth import admin_rights_required
+from streaming import requested_stream_format, stream_json
+from users.auth import JWTAuthorization, admin_rights_required
 from users.json_responses import NoAccessResponse403, UnauthorizedResponse401
-from users.utils import change_user_activity
+from users.utils import change_user_activity, invalidate_principal
+from validation import validate_bulk_items
 
 admin_blueprint = Blueprint("admin", url_prefix="api/admin/")
 
 
+def user_to_dict(user) -> dict:
+    bills = []
+
+    if user.bills_id[0]:
+        for i in range(len(user.bills_id)):
+            bills.append(
+                {
+                    "id": user.bills_id[i],
+                    "balance": user.bills_balance[i],
+                }
+            )
+
+    return {
+        "id": user.id,
+        "username": user.username,
+        "is_active": user.is_active,
+        "is_admin": user.is_admin,
+        "bills": bills,
+    }
+
+
+def bulk_results(items_count: int, errors: dict) -> list:
+    """Per item results of a bulk request with the invalid items filled in"""
+    results = [None] * items_count
+    for index, item_errors in errors.items():
+        results[index] = {
+            "index": index,
+            "status": "invalid",
+            "errors": item_errors,
+        }
+    return results
+
+
 class ProductsCRUD:
     @staticmethod
     @openapi.summary("Retrieve products")
@@ -34,6 +82,27 @@ class ProductsCRUD:
         required=True,
         description="Bearer Token",
     )
+    @openapi.parameter(
+        "after",
+        int,
+        location="query",
+        description="next value of the last page",
+    )
+    @openapi.parameter(
+        "limit", int, location="query", description="Products per page"
+    )
+    @openapi.parameter(
+        "fields",
+        str,
+        location="query",
+        description="Comma separated fields to return, e.g. title,price",
+    )
+    @openapi.parameter(
+        "all",
+        bool,
+        location="query",
+        description="Return every product in one unpaginated response",
+    )
     @openapi.response(
         201,
         {"application/json": ProductsRetrieveResponse200},
@@ -54,19 +123,33 @@ class ProductsCRUD:
     )
     @admin_rights_required()
     async def get(request: Request):
-        products = await get_all_products(request.app.config["database"])
-        data = []
-        for product in products:
-            data.append(
-                {
-                    "id": product.id,
-                    "title": product.title,
-                    "description": product.description,
-                    "price": product.price,
-                }
+        database = request.app.config["database"]
+        if request.args.get("all") == "true":
+            snapshot = await catalog.get(database)
+            body, encoding = encode_cached(
+                request, snapshot.body, snapshot.variants
             )
-        result = {"products": data}
-        return response.json(result, status=200)
+            headers = {"Vary": "Accept-Encoding"}
+            if encoding:
+                headers["Content-Encoding"] = encoding
+            return response.raw(
+                body,
+                status=200,
+                headers=headers,
+                content_type="application/json",
+            )
+
+        try:
+            after, limit, fields = parse_page_args(request.args)
+        except ValueError as error:
+            return response.json({"error": str(error)}, status=400)
+
+        products, next_cursor = await get_products_page(
+            database, after, limit, fields
+        )
+        return response.json(
+            {"products": products, "next": next_cursor}, status=200
+        )
 
     @staticmethod
     @openapi.summary("Create a product")
@@ -111,6 +194,7 @@ class ProductsCRUD:
         await create_product(
             request.app.config["database"], title, description, price
         )
+        await invalidate_catalog(request.app.config["redis"])
         return response.json(
             {"message": "The product was successfully created"}, status=201
         )
@@ -161,6 +245,7 @@ class ProductsCRUD:
         await update_product(
             request.app.config["database"], id_, title, description, price
         )
+        await invalidate_catalog(request.app.config["redis"])
         return response.json(
             {"message": "The product was successfully updated"}, status=200
         )
@@ -207,11 +292,203 @@ class ProductsCRUD:
             request.app.config["database"],
             id_,
         )
+        await invalidate_catalog(request.app.config["redis"])
         return response.json(
             {"message": "The product was successfully deleted"}, status=200
         )
 
 
+class ProductsBulk:
+    @staticmethod
+    @openapi.summary("Create products in bulk")
+    @openapi.description(
+        "Post an array of products, they are created with one statement. "
+        "Invalid items are reported and skipped"
+    )
+    @openapi.tag("Admin")
+    @openapi.parameter(
+        "Authorization",
+        str,
+        location="header",
+        required=True,
+        description="Bearer Token",
+    )
+    @openapi.body(
+        {"application/json": ProductsBulkCreateRequestBody},
+        description="",
+        required=True,
+    )
+    @openapi.response(
+        200,
+        {"application/json": ProductsBulkResponse200},
+        "Successful Response",
+    )
+    @openapi.response(
+        401,
+        {"application/json": UnauthorizedResponse401},
+        "Unauthorized Error",
+    )
+    @openapi.response(
+        403,
+        {"application/json": NoAccessResponse403},
+        "Unauthorized Error",
+    )
+    @admin_blueprint.route(
+        "/products/bulk", name="products-bulk-create", methods=("POST",)
+    )
+    @validate_json(products_bulk_create_schema)
+    @admin_rights_required()
+    async def post(request):
+        items = request.json.get("products")
+        valid, errors = validate_bulk_items(items, product_create_schema)
+        results = bulk_results(len(items), errors)
+
+        if valid:
+            ids = await bulk_create_products(
+                request.app.config["database"], [items[i] for i in valid]
+            )
+            await invalidate_catalog(request.app.config["redis"])
+            for index, product_id in zip(valid, ids):
+                results[index] = {
+                    "index": index,
+                    "status": "created",
+                    "id": product_id,
+                }
+
+        return response.json({"results": results}, status=200)
+
+    @staticmethod
+    @openapi.summary("Update products in bulk")
+    @openapi.description(
+        "Send an array of products with their ids, they are updated with "
+        "one statement. Invalid and unknown items are reported"
+    )
+    @openapi.tag("Admin")
+    @openapi.parameter(
+        "Authorization",
+        str,
+        location="header",
+        required=True,
+        description="Bearer Token",
+    )
+    @openapi.body(
+        {"application/json": ProductsBulkUpdateRequestBody},
+        description="",
+        required=True,
+    )
+    @openapi.response(
+        200,
+        {"application/json": ProductsBulkResponse200},
+        "Successful Response",
+    )
+    @openapi.response(
+        401,
+        {"application/json": UnauthorizedResponse401},
+        "Unauthorized Error",
+    )
+    @openapi.response(
+        403,
+        {"application/json": NoAccessResponse403},
+        "Unauthorized Error",
+    )
+    @admin_blueprint.route(
+        "/products/bulk", name="products-bulk-update", methods=("PUT",)
+    )
+    @validate_json(products_bulk_update_schema)
+    @admin_rights_required()
+    async def put(request):
+        items = request.json.get("products")
+        valid, errors = validate_bulk_items(items, product_update_schema)
+
+        # An id can be updated only once per statement
+        seen = set()
+        unique = []
+        for index in valid:
+            if items[index]["id"] in seen:
+                errors[index] = {"id": ["duplicate id in the request"]}
+            else:
+                seen.add(items[index]["id"])
+                unique.append(index)
+        results = bulk_results(len(items), errors)
+
+        if unique:
+            updated = set(
+                await bulk_update_products(
+                    request.app.config["database"],
+                    [items[i] for i in unique],
+                )
+            )
+            await invalidate_catalog(request.app.config["redis"])
+            for index in unique:
+                product_id = items[index]["id"]
+                results[index] = {
+                    "index": index,
+                    "status": "updated"
+                    if product_id in updated
+                    else "not_found",
+                    "id": product_id,
+                }
+
+        return response.json({"results": results}, status=200)
+
+    @staticmethod
+    @openapi.summary("Delete products in bulk")
+    @openapi.description(
+        "Send an array of product ids, they are deleted with one statement"
+    )
+    @openapi.tag("Admin")
+    @openapi.parameter(
+        "Authorization",
+        str,
+        location="header",
+        required=True,
+        description="Bearer Token",
+    )
+    @openapi.body(
+        {"application/json": ProductsBulkDeleteRequestBody},
+        description="",
+        required=True,
+    )
+    @openapi.response(
+        200,
+        {"application/json": ProductsBulkResponse200},
+        "Successful Response",
+    )
+    @openapi.response(
+        401,
+        {"application/json": UnauthorizedResponse401},
+        "Unauthorized Error",
+    )
+    @openapi.response(
+        403,
+        {"application/json": NoAccessResponse403},
+        "Unauthorized Error",
+    )
+    @admin_blueprint.route(
+        "/products/bulk", name="products-bulk-delete", methods=("DELETE",)
+    )
+    @validate_json(products_bulk_delete_schema)
+    @admin_rights_required()
+    async def delete(request):
+        ids = request.json.get("ids")
+        deleted = set(
+            await bulk_delete_products(
+                request.app.config["database"], list(set(ids))
+            )
+        )
+        await invalidate_catalog(request.app.config["redis"])
+
+        results = [
+            {
+                "index": index,
+                "status": "deleted" if product_id in deleted else "not_found",
+                "id": product_id,
+            }
+            for index, product_id in enumerate(ids)
+        ]
+        return response.json({"results": results}, status=200)
+
+
 class UsersManagement:
     @staticmethod
     @openapi.summary("Get detailed users data")
@@ -241,6 +518,14 @@ class UsersManagement:
         {"application/json": NoAccessResponse403},
         "Unauthorized Error",
     )
+    @openapi.parameter(
+        "stream",
+        bool,
+        location="query",
+        description=(
+            "Stream the users, send Accept: application/x-ndjson for NDJSON"
+        ),
+    )
     @admin_blueprint.route(
         "/users", name="user-bills-retrieve", methods=("GET",)
     )
@@ -259,34 +544,22 @@ class UsersManagement:
                    ORDER BY users.id;
                 """
 
+        stream_format = requested_stream_format(request)
+        if stream_format:
+            await stream_json(
+                request,
+                "users",
+                database.iterate(query=query),
+                user_to_dict,
+                stream_format,
+            )
+            return
+
         users = await database.fetch_all(
             query=query,
         )
-        data = []
 
-        for user in users:
-            bills = []
-
-            if user.bills_id[0]:
-                for i in range(len(user.bills_id)):
-                    bills.append(
-                        {
-                            "id": user.bills_id[i],
-                            "balance": user.bills_balance[i],
-                        }
-                    )
-
-            data.append(
-                {
-                    "id": user.id,
-                    "username": user.username,
-                    "is_active": user.is_active,
-                    "is_admin": user.is_admin,
-                    "bills": bills,
-                }
-            )
-
-        result = {"users": data}
+        result = {"users": [user_to_dict(user) for user in users]}
         return response.json(result, status=200)
 
     @staticmethod
@@ -331,5 +604,43 @@ class UsersManagement:
         await change_user_activity(
             request.app.config["database"], user_id, is_active
         )
+        await invalidate_principal(request.app.config["redis"], user_id)
+        if not is_active:
+            await JWTAuthorization.revoke_cached_tokens(
+                request, user_id=user_id
+            )
         s = "activated" if is_active else "deactivated"
         return response.json({"message": f"The user is {s}"}, status=200)
+
+
+@openapi.summary("Worker metrics")
+@openapi.description(
+    "Cache sizes and hit rates of the worker that served the request"
+)
+@openapi.tag("Admin")
+@openapi.parameter(
+    "Authorization",
+    str,
+    location="header",
+    required=True,
+    description="Bearer Token",
+)
+@openapi.response(
+    200,
+    {"application/json": MetricsResponse200},
+    "Successful Response",
+)
+@openapi.response(
+    401,
+    {"application/json": UnauthorizedResponse401},
+    "Unauthorized Error",
+)
+@openapi.response(
+    403,
+    {"application/json": NoAccessResponse403},
+    "Unauthorized Error",
+)
+@admin_blueprint.route("/metrics", name="metrics", methods=("GET",))
+@admin_rights_required()
+async def metrics(request: Request):
+    return response.json(collect_metrics(), status=200)
@@ -15,6 +15,13 @@ class ProductDeleteResponse200:
     message = "The product was successfully deleted"
 
 
+class ProductsBulkResponse200:
+    results = [
+        {"index": 0, "status": "created", "id": 5},
+        {"index": 1, "status": "invalid", "errors": {"price": ["required"]}},
+    ]
+
+
 # Users
 class UsersGetResponse200:
     users = "data list"
@@ -22,3 +29,8 @@ class UsersGetResponse200:
 
 class UserPatchResponse200:
     message = "The user is 'activated / deactivated' successfully"
+
+
+# Metrics
+class MetricsResponse200:
+    token_cache = "size, maxsize, hits, misses, hit_rate"
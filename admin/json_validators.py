@@ -1,6 +1,11 @@
+import settings
+from validation import INT32_MAX
+
 # Products
 id_ = {
     "type": "integer",
+    "min": 1,
+    "max": INT32_MAX,
     "required": True,
 }
 
@@ -17,6 +22,8 @@ description = {
 
 price = {
     "type": "integer",
+    "min": 0,
+    "max": INT32_MAX,
     "required": True,
 }
 
@@ -36,6 +43,25 @@ product_update_schema = {
 product_delete_schema = {"id": id_}
 
 
+def bulk_schema(key: str, item_schema: dict = None):
+    return {
+        key: {
+            "type": "list",
+            "required": True,
+            "minlength": 1,
+            "maxlength": settings.PRODUCTS_BULK_MAX_SIZE,
+            "schema": item_schema or {"type": "dict"},
+        }
+    }
+
+
+products_bulk_create_schema = bulk_schema("products")
+products_bulk_update_schema = bulk_schema("products")
+products_bulk_delete_schema = bulk_schema(
+    "ids", {"type": "integer", "min": 1, "max": INT32_MAX}
+)
+
+
 class ProductCreateRequestBody:
     title = "String"
     description = "Text"
@@ -53,6 +79,20 @@ class ProductDeleteRequestBody:
     id = 5
 
 
+class ProductsBulkCreateRequestBody:
+    products = [{"title": "String", "description": "Text", "price": 150}]
+
+
+class ProductsBulkUpdateRequestBody:
+    products = [
+        {"id": 5, "title": "String", "description": "Text", "price": 150}
+    ]
+
+
+class ProductsBulkDeleteRequestBody:
+    ids = [5, 6]
+
+
 # Users
 is_active = {
     "type": "boolean",
@@ -0,0 +1,28 @@
+"""user_verification created_at
+
+Revision ID: 8c1f2d7a9b3e
+Revises: 445918f1053a
+Create Date: 2026-10-18 10:12:31.402118
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '8c1f2d7a9b3e'
+down_revision = '445918f1053a'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('user_verification',
+    sa.Column('created_at', sa.DateTime(), server_default=sa.text('now()'), nullable=False)
+    )
+    op.create_index(op.f('ix_user_verification_created_at'), 'user_verification', ['created_at'], unique=False)
+
+
+def downgrade():
+    op.drop_index(op.f('ix_user_verification_created_at'), table_name='user_verification')
+    op.drop_column('user_verification', 'created_at')
@@ -0,0 +1,24 @@
+"""transaction history index
+
+Revision ID: a7c3e9f14b62
+Revises: d41e6b0c7f25
+Create Date: 2026-10-18 15:02:44.918273
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'a7c3e9f14b62'
+down_revision = 'd41e6b0c7f25'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_index('ix_transaction_bill_id_created_at_id', 'transaction', ['bill_id', 'created_at', 'id'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_transaction_bill_id_created_at_id', table_name='transaction')
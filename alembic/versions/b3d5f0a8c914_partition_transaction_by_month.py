@@ -0,0 +1,144 @@
+"""partition transaction by month
+
+Revision ID: b3d5f0a8c914
+Revises: a7c3e9f14b62
+Create Date: 2026-10-18 16:27:05.630912
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'b3d5f0a8c914'
+down_revision = 'a7c3e9f14b62'
+branch_labels = None
+depends_on = None
+
+
+CREATE_PARTITION_FUNCTION = """
+CREATE OR REPLACE FUNCTION create_transaction_partition(month date)
+RETURNS void AS $$
+DECLARE
+    month_start timestamp := date_trunc('month', month);
+    month_end timestamp := date_trunc('month', month) + interval '1 month';
+    partition_name text := 'transaction_p' || to_char(month_start, 'YYYYMM');
+BEGIN
+    -- Workers call this concurrently, the first one creates the partition
+    PERFORM pg_advisory_xact_lock(hashtext('transaction_partitions'));
+    IF to_regclass(partition_name) IS NOT NULL THEN
+        RETURN;
+    END IF;
+
+    -- Deposits of the month may already be in the default partition, the
+    -- partition can't be attached before they are moved to it
+    EXECUTE format(
+        'CREATE TABLE %I (LIKE transaction INCLUDING DEFAULTS)',
+        partition_name
+    );
+    LOCK TABLE transaction_default IN ACCESS EXCLUSIVE MODE;
+    EXECUTE format(
+        'WITH moved AS ('
+        '    DELETE FROM transaction_default'
+        '    WHERE created_at >= %L AND created_at < %L'
+        '    RETURNING id, deposit, bill_id, created_at'
+        ') INSERT INTO %I(id, deposit, bill_id, created_at) '
+        'SELECT id, deposit, bill_id, created_at FROM moved',
+        month_start, month_end, partition_name
+    );
+    EXECUTE format(
+        'ALTER TABLE transaction ATTACH PARTITION %I '
+        'FOR VALUES FROM (%L) TO (%L)',
+        partition_name, month_start, month_end
+    );
+END;
+$$ LANGUAGE plpgsql;
+"""
+
+CREATE_PARTITIONS_FUNCTION = """
+CREATE OR REPLACE FUNCTION create_transaction_partitions(months_ahead int)
+RETURNS void AS $$
+DECLARE
+    month date;
+BEGIN
+    PERFORM pg_advisory_xact_lock(hashtext('transaction_partitions'));
+    FOR i IN 0..months_ahead LOOP
+        month := (date_trunc('month', now()) + make_interval(months => i))::date;
+        -- A failed month doesn't stop the following ones
+        BEGIN
+            PERFORM create_transaction_partition(month);
+        EXCEPTION WHEN OTHERS THEN
+            RAISE WARNING 'Can''t create the transaction partition of %: %',
+                month, SQLERRM;
+        END;
+    END LOOP;
+END;
+$$ LANGUAGE plpgsql;
+"""
+
+
+def upgrade():
+    # Ids must stay unique across partitions, but a primary key of a
+    # partitioned table has to include the partition key
+    op.create_table('transaction_key',
+    sa.Column('id', sa.INTEGER(), autoincrement=False, nullable=False),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.execute('INSERT INTO transaction_key(id) SELECT id FROM transaction')
+
+    op.drop_index('ix_transaction_bill_id_created_at_id', table_name='transaction')
+    op.rename_table('transaction', 'transaction_unpartitioned')
+    op.execute('ALTER TABLE transaction_unpartitioned RENAME CONSTRAINT transaction_pkey TO transaction_unpartitioned_pkey')
+    op.create_table('transaction',
+    sa.Column('id', sa.INTEGER(), autoincrement=False, nullable=False),
+    sa.Column('deposit', sa.INTEGER(), nullable=False),
+    sa.Column('bill_id', sa.INTEGER(), nullable=False),
+    sa.Column('created_at', sa.DateTime(), nullable=False),
+    sa.ForeignKeyConstraint(['bill_id'], ['bill.id'], ),
+    sa.PrimaryKeyConstraint('id', 'created_at'),
+    postgresql_partition_by='RANGE (created_at)'
+    )
+    op.create_index('ix_transaction_bill_id_created_at_id', 'transaction', ['bill_id', 'created_at', 'id'], unique=False)
+    op.execute('CREATE TABLE transaction_default PARTITION OF transaction DEFAULT')
+
+    op.execute(CREATE_PARTITION_FUNCTION)
+    op.execute(CREATE_PARTITIONS_FUNCTION)
+    op.execute("""
+        SELECT create_transaction_partition(month::date)
+        FROM generate_series(
+            (SELECT date_trunc('month', min(created_at)) FROM transaction_unpartitioned),
+            date_trunc('month', now()),
+            interval '1 month'
+        ) AS month
+    """)
+    op.execute('SELECT create_transaction_partitions(3)')
+
+    op.execute("""
+        INSERT INTO transaction(id, deposit, bill_id, created_at)
+        SELECT id, deposit, bill_id, created_at FROM transaction_unpartitioned
+    """)
+    op.drop_table('transaction_unpartitioned')
+
+
+def downgrade():
+    op.rename_table('transaction', 'transaction_partitioned')
+    op.execute('ALTER TABLE transaction_partitioned RENAME CONSTRAINT transaction_pkey TO transaction_partitioned_pkey')
+    op.drop_index('ix_transaction_bill_id_created_at_id', table_name='transaction_partitioned')
+    op.create_table('transaction',
+    sa.Column('id', sa.INTEGER(), nullable=False),
+    sa.Column('deposit', sa.INTEGER(), nullable=False),
+    sa.Column('bill_id', sa.INTEGER(), nullable=False),
+    sa.Column('created_at', sa.DateTime(), nullable=False),
+    sa.ForeignKeyConstraint(['bill_id'], ['bill.id'], ),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index('ix_transaction_bill_id_created_at_id', 'transaction', ['bill_id', 'created_at', 'id'], unique=False)
+    op.execute("""
+        INSERT INTO transaction(id, deposit, bill_id, created_at)
+        SELECT id, deposit, bill_id, created_at FROM transaction_partitioned
+    """)
+    # Drops every partition with it
+    op.drop_table('transaction_partitioned')
+    op.execute('DROP FUNCTION create_transaction_partitions(int)')
+    op.execute('DROP FUNCTION create_transaction_partition(date)')
+    op.drop_table('transaction_key')
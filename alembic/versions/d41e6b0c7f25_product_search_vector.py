@@ -0,0 +1,28 @@
+"""product search_vector
+
+Revision ID: d41e6b0c7f25
+Revises: 8c1f2d7a9b3e
+Create Date: 2026-10-18 13:40:07.215390
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+# revision identifiers, used by Alembic.
+revision = 'd41e6b0c7f25'
+down_revision = '8c1f2d7a9b3e'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('product',
+    sa.Column('search_vector', postgresql.TSVECTOR(), sa.Computed("setweight(to_tsvector('simple', title), 'A') || setweight(to_tsvector('simple', description), 'B')", persisted=True), nullable=True)
+    )
+    op.create_index('ix_product_search_vector', 'product', ['search_vector'], unique=False, postgresql_using='gin')
+
+
+def downgrade():
+    op.drop_index('ix_product_search_vector', table_name='product', postgresql_using='gin')
+    op.drop_column('product', 'search_vector')
@@ -0,0 +1,87 @@
+"""Latency of an unrelated route while logins are running.
+
+    python -m benchmarks.auth_load --username admin --login-clients 32
+
+Measures --probe-path alone for --duration seconds, then again while
+--login-clients clients send logins of --username as fast as they can.
+A wrong --password still runs the full password hash, so the default
+doesn't create tokens. Start the server first.
+
+With more login clients than HASH_CONCURRENCY + HASH_QUEUE_SIZE the
+extra logins must be rejected quickly with 503 and Retry-After. The
+exit status is 1 if the probe p99 under load is more than
+--max-p99-ratio times the p99 alone, or a 503 lacks Retry-After.
+"""
+import argparse
+import asyncio
+
+from benchmarks.load import Client, Recorder, run_for
+
+
+async def probe(url: str, path: str, duration: float) -> Recorder:
+    client = Client(url)
+    recorder = Recorder()
+    await run_for(
+        duration, lambda _: recorder.timed(client, "GET", path), clients=1
+    )
+    await client.close()
+    return recorder
+
+
+async def logins(url: str, credentials: dict, clients: int, duration: float):
+    connections = [Client(url) for _ in range(clients)]
+    recorder = Recorder()
+    # 503 responses, their latency and how many lacked Retry-After
+    rejected = Recorder()
+
+    async def login(number: int):
+        response = await recorder.timed(
+            connections[number], "POST", "/api/login", body=credentials
+        )
+        if response is not None and response.status == 503:
+            rejected.latencies.append(recorder.latencies[-1])
+            if "retry-after" not in response.headers:
+                rejected.errors += 1
+
+    await run_for(duration, login, clients=clients)
+    for client in connections:
+        await client.close()
+    return recorder, rejected
+
+
+async def run(args):
+    credentials = {"username": args.username, "password": args.password}
+    idle = await probe(args.url, args.probe_path, args.duration)
+    print(f"{args.probe_path} alone: {idle.summary()}")
+
+    loaded, (login, rejected) = await asyncio.gather(
+        probe(args.url, args.probe_path, args.duration),
+        logins(args.url, credentials, args.login_clients, args.duration),
+    )
+    print(f"{args.probe_path} during logins: {loaded.summary()}")
+    print(f"/api/login x{args.login_clients}: {login.summary()}")
+    print(
+        f"rejected with 503: {len(rejected.latencies)}, "
+        f"p99 {rejected.percentile(99):.1f} ms, "
+        f"without Retry-After {rejected.errors}"
+    )
+
+    ratio = loaded.percentile(99) / max(idle.percentile(99), 0.001)
+    print(f"probe p99 ratio under load: {ratio:.2f}")
+    return ratio <= args.max_p99_ratio and not rejected.errors
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--url", default="http://127.0.0.1:8000")
+    parser.add_argument("--username", required=True)
+    parser.add_argument("--password", default="wrong-password")
+    parser.add_argument("--probe-path", default="/api/products-list?limit=50")
+    parser.add_argument("--login-clients", type=int, default=32)
+    parser.add_argument("--duration", type=float, default=10)
+    parser.add_argument("--max-p99-ratio", type=float, default=2)
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    raise SystemExit(0 if asyncio.run(run(parse_args())) else 1)
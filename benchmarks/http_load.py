@@ -0,0 +1,63 @@
+"""Throughput and latency of one route under concurrent clients.
+
+    python -m benchmarks.http_load /api/products-list?limit=50 --clients 50
+
+Also counts the responses that set a cookie: since sessions are opt-in
+per route, the catalog, payment and admin routes must set none. Run it
+against a server started from the commit before a change to compare
+the per-request overhead. Start the server first.
+"""
+import argparse
+import asyncio
+import time
+
+from benchmarks.load import Client, Recorder, run_for
+
+
+async def run(args) -> bool:
+    connections = [Client(args.url) for _ in range(args.clients)]
+    headers = dict(header.split(": ", 1) for header in args.header)
+    recorder = Recorder()
+    cookies = 0
+
+    async def send(number: int):
+        nonlocal cookies
+        response = await recorder.timed(
+            connections[number], "GET", args.path, headers=headers
+        )
+        if response is not None and "set-cookie" in response.headers:
+            cookies += 1
+
+    started = time.perf_counter()
+    await run_for(args.duration, send, clients=args.clients)
+    elapsed = time.perf_counter() - started
+    for client in connections:
+        await client.close()
+
+    print(f"{args.path} x{args.clients}: {recorder.summary()}")
+    print(
+        f"{len(recorder.latencies) / elapsed:,.0f} requests/s, "
+        f"{cookies} responses set a cookie"
+    )
+    return not cookies or args.allow_cookies
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("path")
+    parser.add_argument("--url", default="http://127.0.0.1:8000")
+    parser.add_argument("--clients", type=int, default=50)
+    parser.add_argument("--duration", type=float, default=10)
+    parser.add_argument(
+        "--header",
+        action="append",
+        default=[],
+        help='Extra request header, e.g. "Authorization: Bearer ..."',
+    )
+    parser.add_argument("--allow-cookies", action="store_true")
+    args = parser.parse_args()
+    raise SystemExit(0 if asyncio.run(run(args)) else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,125 @@
+"""Minimal keep-alive HTTP/1.1 client for the load benchmarks"""
+import asyncio
+import json
+import time
+from collections import Counter
+from typing import Dict, List, NamedTuple, Optional
+from urllib.parse import urlsplit
+
+
+class Response(NamedTuple):
+    status: int
+    headers: Dict[str, str]
+    body: bytes
+
+
+class Client:
+    """One connection, requests are sent one after another"""
+
+    def __init__(self, url: str):
+        parts = urlsplit(url)
+        self.host = parts.hostname
+        self.port = parts.port or 80
+        self._reader: Optional[asyncio.StreamReader] = None
+        self._writer: Optional[asyncio.StreamWriter] = None
+
+    async def _connect(self):
+        self._reader, self._writer = await asyncio.open_connection(
+            self.host, self.port
+        )
+
+    async def request(
+        self,
+        method: str,
+        path: str,
+        body=None,
+        headers: Dict[str, str] = None,
+    ) -> Response:
+        if self._writer is None:
+            await self._connect()
+        payload = b"" if body is None else json.dumps(body).encode()
+        lines = [
+            f"{method} {path} HTTP/1.1",
+            f"Host: {self.host}:{self.port}",
+            f"Content-Length: {len(payload)}",
+        ]
+        if body is not None:
+            lines.append("Content-Type: application/json")
+        lines.extend(
+            f"{name}: {value}" for name, value in (headers or {}).items()
+        )
+        self._writer.write(
+            ("\r\n".join(lines) + "\r\n\r\n").encode() + payload
+        )
+        try:
+            return await self._read_response()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            await self.close()
+            raise
+
+    async def _read_response(self) -> Response:
+        head = await self._reader.readuntil(b"\r\n\r\n")
+        status_line, *header_lines = head.decode("latin-1").split("\r\n")
+        response_headers = {}
+        for line in header_lines:
+            if line:
+                name, _, value = line.partition(":")
+                response_headers[name.strip().lower()] = value.strip()
+        length = int(response_headers.get("content-length", 0))
+        body = await self._reader.readexactly(length) if length else b""
+        if response_headers.get("connection", "").lower() == "close":
+            await self.close()
+        return Response(int(status_line.split()[1]), response_headers, body)
+
+    async def close(self):
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+            self._reader = None
+
+
+class Recorder:
+    """Latencies and status codes of the requests of one phase"""
+
+    def __init__(self):
+        self.latencies: List[float] = []
+        self.statuses = Counter()
+        self.errors = 0
+
+    async def timed(self, client: Client, *args, **kwargs):
+        started = time.perf_counter()
+        try:
+            response = await client.request(*args, **kwargs)
+        except (OSError, asyncio.IncompleteReadError):
+            self.errors += 1
+            return None
+        self.latencies.append(time.perf_counter() - started)
+        self.statuses[response.status] += 1
+        return response
+
+    def percentile(self, percent: float) -> float:
+        if not self.latencies:
+            return 0.0
+        ordered = sorted(self.latencies)
+        index = min(len(ordered) - 1, int(len(ordered) * percent / 100))
+        return ordered[index] * 1000
+
+    def summary(self) -> str:
+        return (
+            f"{len(self.latencies)} requests, "
+            f"p50 {self.percentile(50):.1f} ms, "
+            f"p99 {self.percentile(99):.1f} ms, "
+            f"max {self.percentile(100):.1f} ms, "
+            f"statuses {dict(self.statuses)}, errors {self.errors}"
+        )
+
+
+async def run_for(duration: float, worker, clients: int):
+    """Run clients copies of worker(client_number) until duration elapses"""
+    deadline = time.monotonic() + duration
+
+    async def loop(number: int):
+        while time.monotonic() < deadline:
+            await worker(number)
+
+    await asyncio.gather(*(loop(number) for number in range(clients)))
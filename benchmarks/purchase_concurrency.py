@@ -0,0 +1,125 @@
+"""Hammer one bill with concurrent purchases.
+
+    python -m benchmarks.purchase_concurrency --clients 50 --purchases 2000
+
+Creates a user, a bill and a product, runs the purchases through
+payment.utils.purchase_product on a pool of --clients connections and
+checks that the bill is never overdrawn and no charge is lost. The rows
+are deleted afterwards.
+"""
+import argparse
+import asyncio
+import time
+import uuid
+
+from databases import Database
+
+import settings
+from payment.utils import purchase_product
+
+
+async def create_fixtures(database: Database, balance: int, price: int):
+    user_id = await database.fetch_val(
+        query="""
+            INSERT INTO users(username, hashed_password)
+            VALUES (:username, '!') RETURNING id
+        """,
+        values={"username": f"benchmark_{uuid.uuid4().hex[:16]}"},
+    )
+    bill_id = await database.fetch_val(
+        query="""
+            INSERT INTO bill(id, balance, user_id)
+            SELECT COALESCE(MAX(id), 0) + 1, :balance, :user_id FROM bill
+            RETURNING id
+        """,
+        values={"balance": balance, "user_id": user_id},
+    )
+    product_id = await database.fetch_val(
+        query="""
+            INSERT INTO product(title, description, price)
+            VALUES ('benchmark', 'purchase concurrency benchmark', :price)
+            RETURNING id
+        """,
+        values={"price": price},
+    )
+    return user_id, bill_id, product_id
+
+
+async def delete_fixtures(database: Database, user_id, bill_id, product_id):
+    await database.execute(
+        query="DELETE FROM product WHERE id = :id", values={"id": product_id}
+    )
+    await database.execute(
+        query="DELETE FROM bill WHERE id = :id", values={"id": bill_id}
+    )
+    await database.execute(
+        query="DELETE FROM users WHERE id = :id", values={"id": user_id}
+    )
+
+
+async def run(clients: int, purchases: int, balance: int, price: int):
+    database = Database(settings.connection, min_size=1, max_size=clients)
+    await database.connect()
+    user_id, bill_id, product_id = await create_fixtures(
+        database, balance, price
+    )
+    try:
+        semaphore = asyncio.Semaphore(clients)
+        lowest = balance
+
+        async def purchase():
+            nonlocal lowest
+            async with semaphore:
+                result = await purchase_product(
+                    database, product_id, bill_id, user_id
+                )
+            if result["balance"] is not None:
+                lowest = min(lowest, result["balance"])
+            return result["balance"] is not None
+
+        started = time.perf_counter()
+        results = await asyncio.gather(*(purchase() for _ in range(purchases)))
+        elapsed = time.perf_counter() - started
+
+        final = await database.fetch_val(
+            query="SELECT balance FROM bill WHERE id = :id",
+            values={"id": bill_id},
+        )
+        charged = sum(results)
+        expected = min(purchases, balance // price)
+        print(
+            f"{purchases} purchases from {clients} clients in "
+            f"{elapsed:.2f} s ({purchases / elapsed:.0f}/s)"
+        )
+        print(
+            f"charged {charged}, expected {expected}, "
+            f"final balance {final}, lowest balance seen {lowest}"
+        )
+        ok = (
+            final >= 0
+            and lowest >= 0
+            and charged == expected
+            and final == balance - charged * price
+        )
+        print("OK" if ok else "FAILED: the bill was overdrawn or lost updates")
+        return ok
+    finally:
+        await delete_fixtures(database, user_id, bill_id, product_id)
+        await database.disconnect()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--clients", type=int, default=50)
+    parser.add_argument("--purchases", type=int, default=2000)
+    parser.add_argument("--balance", type=int, default=100000)
+    parser.add_argument("--price", type=int, default=70)
+    args = parser.parse_args()
+    ok = asyncio.run(
+        run(args.clients, args.purchases, args.balance, args.price)
+    )
+    raise SystemExit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,103 @@
+"""Token lookups under concurrency, blocking client against redis.asyncio.
+
+    python -m benchmarks.redis_tokens --clients 100 --lookups 100
+
+--clients coroutines each read a stored token --lookups times, first
+through the blocking client the token storage used before (every call
+stalls the event loop), then through the asyncio pool it uses now.
+Prints the lookup latency and how late a 1 ms timer fires meanwhile,
+which is what the other requests of the worker wait. Needs redis.
+"""
+import argparse
+import asyncio
+import time
+
+import redis
+from redis.asyncio import Redis
+
+import settings
+from benchmarks.load import Recorder
+from main import get_redis_pool
+
+TOKEN_KEY = "benchmark_tokens_user"
+
+
+async def measure_loop_lag(stop: asyncio.Event) -> Recorder:
+    lag = Recorder()
+    while not stop.is_set():
+        started = time.perf_counter()
+        await asyncio.sleep(0.001)
+        lag.latencies.append(time.perf_counter() - started - 0.001)
+    return lag
+
+
+async def run_clients(lookup, clients: int, lookups: int):
+    latencies = Recorder()
+    stop = asyncio.Event()
+    lag_task = asyncio.create_task(measure_loop_lag(stop))
+
+    async def client():
+        for _ in range(lookups):
+            started = time.perf_counter()
+            await lookup()
+            latencies.latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(client() for _ in range(clients)))
+    elapsed = time.perf_counter() - started
+    stop.set()
+    return latencies, await lag_task, clients * lookups / elapsed
+
+
+def report(name: str, latencies: Recorder, lag: Recorder, rate: float):
+    print(
+        f"{name}: {rate:,.0f} lookups/s, "
+        f"latency p50 {latencies.percentile(50):.2f} ms "
+        f"p99 {latencies.percentile(99):.2f} ms, "
+        f"loop lag p99 {lag.percentile(99):.2f} ms "
+        f"max {lag.percentile(100):.2f} ms"
+    )
+
+
+async def run(clients: int, lookups: int):
+    blocking = redis.Redis(
+        host=settings.REDIS_HOST,
+        port=settings.REDIS_PORT,
+        max_connections=settings.REDIS_MAX_CONNECTIONS,
+    )
+    pool = get_redis_pool()
+    conn = Redis(connection_pool=pool)
+    await conn.set(TOKEN_KEY, "{}")
+    try:
+
+        async def blocking_lookup():
+            blocking.get(TOKEN_KEY)
+
+        async def asyncio_lookup():
+            await conn.get(TOKEN_KEY)
+
+        report(
+            "blocking (before)",
+            *await run_clients(blocking_lookup, clients, lookups),
+        )
+        report(
+            "redis.asyncio (after)",
+            *await run_clients(asyncio_lookup, clients, lookups),
+        )
+    finally:
+        await conn.delete(TOKEN_KEY)
+        await conn.close()
+        await pool.disconnect()
+        blocking.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--clients", type=int, default=100)
+    parser.add_argument("--lookups", type=int, default=100)
+    args = parser.parse_args()
+    asyncio.run(run(args.clients, args.lookups))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,43 @@
+"""Cost of checking a session token, HMAC digest against legacy PBKDF2.
+
+    python -m benchmarks.token_digest --rounds 20
+
+Every authenticated request of the redis token mode checks the token
+once, so the checks per second bound the authenticated requests per
+second of a worker. Needs no running server, database or redis.
+"""
+import argparse
+import time
+import uuid
+
+from users.utils import (generate_hash, generate_token_digest, verify_hash,
+                         verify_token_digest)
+
+
+def per_second(check, rounds: int) -> float:
+    started = time.perf_counter()
+    for _ in range(rounds):
+        assert check()
+    return rounds / (time.perf_counter() - started)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rounds", type=int, default=20)
+    args = parser.parse_args()
+
+    token = str(uuid.uuid4())
+    token_hash = generate_hash(token)
+    token_digest = generate_token_digest(token)
+
+    pbkdf2 = per_second(lambda: verify_hash(token_hash, token), args.rounds)
+    hmac = per_second(
+        lambda: verify_token_digest(token_digest, token), args.rounds * 10000
+    )
+    print(f"PBKDF2 (before): {pbkdf2:,.0f} checks/s per core")
+    print(f"HMAC-SHA256 (after): {hmac:,.0f} checks/s per core")
+    print(f"{hmac / pbkdf2:,.0f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,126 @@
+"""Webhook deposit throughput, shared pool against a connection each.
+
+    python -m benchmarks.webhook_throughput --clients 20 --deposits 2000
+
+Applies --deposits deposits from --clients concurrent senders to bills
+of a benchmark user twice: opening a connection per deposit, as the
+webhook did before, and on the shared pool it uses now. The user, bills
+and transactions are deleted afterwards.
+"""
+import argparse
+import asyncio
+import time
+import uuid
+
+from databases import Database
+
+import settings
+from payment.webhook import BILL_CREATED, DEPOSITED, webhook_db_transaction
+
+
+async def create_user(database: Database) -> int:
+    return await database.fetch_val(
+        query="""
+            INSERT INTO users(username, hashed_password)
+            VALUES (:username, '!') RETURNING id
+        """,
+        values={"username": f"benchmark_{uuid.uuid4().hex[:16]}"},
+    )
+
+
+async def next_id(database: Database, table: str) -> int:
+    return await database.fetch_val(
+        query=f"SELECT COALESCE(MAX(id), 0) + 1 FROM {table}"
+    )
+
+
+async def delete_fixtures(database: Database, user_id: int):
+    bills = "SELECT id FROM bill WHERE user_id = :user_id"
+    await database.execute(
+        query=f"""
+            DELETE FROM transaction_key WHERE id IN (
+                SELECT id FROM transaction WHERE bill_id IN ({bills})
+            )
+        """,
+        values={"user_id": user_id},
+    )
+    await database.execute(
+        query=f"DELETE FROM transaction WHERE bill_id IN ({bills})",
+        values={"user_id": user_id},
+    )
+    await database.execute(
+        query="DELETE FROM bill WHERE user_id = :user_id",
+        values={"user_id": user_id},
+    )
+    await database.execute(
+        query="DELETE FROM users WHERE id = :user_id",
+        values={"user_id": user_id},
+    )
+
+
+async def on_new_connection(user_id, bill_id, transaction_id, amount):
+    database = Database(settings.connection, min_size=1, max_size=1)
+    await database.connect()
+    try:
+        return await webhook_db_transaction(
+            database, user_id, bill_id, transaction_id, amount
+        )
+    finally:
+        await database.disconnect()
+
+
+async def apply(name: str, deposit, clients: int, deposits: list):
+    semaphore = asyncio.Semaphore(clients)
+
+    async def send(item):
+        async with semaphore:
+            return await deposit(*item)
+
+    started = time.perf_counter()
+    outcomes = await asyncio.gather(*(send(item) for item in deposits))
+    elapsed = time.perf_counter() - started
+    applied = sum(outcome in (DEPOSITED, BILL_CREATED) for outcome in outcomes)
+    print(
+        f"{name}: {len(deposits) / elapsed:,.0f} deposits/s, "
+        f"{applied} of {len(deposits)} applied"
+    )
+
+
+async def run(clients: int, count: int, bills: int):
+    database = Database(settings.connection, min_size=1, max_size=clients)
+    await database.connect()
+    user_id = await create_user(database)
+    try:
+
+        async def pooled(user_id, bill_id, transaction_id, amount):
+            return await webhook_db_transaction(
+                database, user_id, bill_id, transaction_id, amount
+            )
+
+        for name, deposit in (
+            ("connection per deposit (before)", on_new_connection),
+            ("shared pool (after)", pooled),
+        ):
+            first_bill = await next_id(database, "bill")
+            first_transaction = await next_id(database, "transaction_key")
+            deposits = [
+                (user_id, first_bill + i % bills, first_transaction + i, 10)
+                for i in range(count)
+            ]
+            await apply(name, deposit, clients, deposits)
+    finally:
+        await delete_fixtures(database, user_id)
+        await database.disconnect()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--clients", type=int, default=20)
+    parser.add_argument("--deposits", type=int, default=2000)
+    parser.add_argument("--bills", type=int, default=100)
+    args = parser.parse_args()
+    asyncio.run(run(args.clients, args.deposits, args.bills))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,175 @@
+import asyncio
+import hashlib
+import json
+import math
+import time
+from collections import OrderedDict
+from typing import Callable, Dict, List
+
+from redis.asyncio import Redis
+from sanic.log import logger
+
+_invalidation_handlers: Dict[str, List[Callable[[dict], None]]] = {}
+
+
+class TTLCache:
+    """Bounded LRU cache, every entry expires after ttl seconds.
+
+    generation changes on every invalidation, a value loaded while an
+    invalidation was applied is not stored if set() gets the generation
+    read before the load.
+    """
+
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.generation = 0
+        self._data = OrderedDict()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key, default=None):
+        item = self._data.get(key)
+        if item is not None:
+            value, expires_at = item
+            if expires_at > time.monotonic():
+                self._data.move_to_end(key)
+                self.hits += 1
+                return value
+            del self._data[key]
+        self.misses += 1
+        return default
+
+    def set(self, key, value, ttl: float = None, generation: int = None):
+        """Store value, ttl can only shorten the default lifetime"""
+        if self.maxsize <= 0:
+            return
+        if generation is not None and generation != self.generation:
+            return
+        ttl = self.ttl if ttl is None else min(ttl, self.ttl)
+        if ttl <= 0:
+            return
+        self._data[key] = (value, time.monotonic() + ttl)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def pop(self, key):
+        self.generation += 1
+        item = self._data.pop(key, None)
+        return item[0] if item else None
+
+    def discard_where(self, predicate: Callable):
+        """Remove the entries for which predicate(key, value) is true"""
+        self.generation += 1
+        stale = [
+            key
+            for key, (value, _) in self._data.items()
+            if predicate(key, value)
+        ]
+        for key in stale:
+            del self._data[key]
+
+    def clear(self):
+        self.generation += 1
+        self._data.clear()
+
+    def stats(self) -> dict:
+        requests = self.hits + self.misses
+        return {
+            "size": len(self._data),
+            "maxsize": self.maxsize,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / requests if requests else 0.0,
+        }
+
+
+class BloomFilter:
+    """Probabilistic set, it can report false positives but never misses
+    an added item"""
+
+    def __init__(self, capacity: int, error_rate: float = 0.01):
+        self.capacity = max(capacity, 1)
+        self.error_rate = error_rate
+        self.size = max(
+            8,
+            int(-self.capacity * math.log(error_rate) / math.log(2) ** 2),
+        )
+        self.hash_count = max(
+            1, round(self.size / self.capacity * math.log(2))
+        )
+        self.count = 0
+        self._bits = bytearray((self.size + 7) // 8)
+
+    def _positions(self, item: str):
+        digest = hashlib.blake2b(item.encode("utf-8"), digest_size=16).digest()
+        first = int.from_bytes(digest[:8], "little")
+        second = int.from_bytes(digest[8:], "little") | 1
+        for i in range(self.hash_count):
+            yield (first + i * second) % self.size
+
+    def add(self, item: str):
+        for position in self._positions(item):
+            self._bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def __contains__(self, item: str):
+        return all(
+            self._bits[position >> 3] & (1 << (position & 7))
+            for position in self._positions(item)
+        )
+
+    def stats(self) -> dict:
+        return {
+            "items": self.count,
+            "capacity": self.capacity,
+            "bits": self.size,
+            "hash_count": self.hash_count,
+        }
+
+
+def on_invalidation(channel: str):
+    """Register a handler for messages published on the redis channel"""
+
+    def decorator(func):
+        _invalidation_handlers.setdefault(channel, []).append(func)
+        return func
+
+    return decorator
+
+
+def invalidate_locally(channel: str, message: dict):
+    for handler in _invalidation_handlers.get(channel, ()):
+        handler(message)
+
+
+async def publish_invalidation(conn: Redis, channel: str, message: dict):
+    """Apply the invalidation in this worker and send it to the others"""
+    invalidate_locally(channel, message)
+    if conn is not None:
+        await conn.publish(channel, json.dumps(message))
+
+
+async def listen_for_invalidations(app):
+    """Apply invalidations published by other workers and nodes"""
+    while True:
+        pubsub = app.config["redis_pubsub"].pubsub()
+        try:
+            await pubsub.subscribe(*_invalidation_handlers)
+            async for message in pubsub.listen():
+                if message["type"] != "message":
+                    continue
+                invalidate_locally(
+                    message["channel"].decode(), json.loads(message["data"])
+                )
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            logger.exception("Invalidation listener failed, reconnecting")
+            await asyncio.sleep(1)
+        finally:
+            await pubsub.close()
@@ -1,5 +1,14 @@
+import asyncio
+import gzip
+import json
+import os
+import time
+
 import psycopg2
+from databases import Database
 from manager import Manager
+from psycopg2 import sql
+from redis.asyncio import Redis
 
 import settings
 from users.utils import generate_hash
@@ -10,7 +19,7 @@ manager = Manager()
 @manager.command
 def create_admin(username, password):
 
-    sql = "INSERT INTO users(username, hashed_password, is_active, is_admin) VALUES(%s, %s, %s, %s)"
+    query = "INSERT INTO users(username, hashed_password, is_active, is_admin) VALUES(%s, %s, %s, %s)"
     data = (username, generate_hash(password), True, True)
     connection = None
     try:
@@ -24,7 +33,7 @@ def create_admin(username, password):
         if username_taken:
             return "Username already taken"
 
-        cursor.execute(sql, data)
+        cursor.execute(query, data)
 
         connection.commit()
 
@@ -40,5 +49,161 @@ def create_admin(username, password):
             connection.close()
 
 
+@manager.command
+def cleanup_user_verifications():
+    """Delete activation links older than ACTIVATION_TOKEN_TTL"""
+
+    connection = None
+    try:
+        connection = psycopg2.connect(settings.connection)
+
+        cursor = connection.cursor()
+        cursor.execute(
+            "DELETE FROM user_verification WHERE created_at < NOW() - make_interval(secs => %s)",
+            (settings.ACTIVATION_TOKEN_TTL,),
+        )
+        deleted = cursor.rowcount
+
+        connection.commit()
+
+        cursor.close()
+    except (Exception, psycopg2.DatabaseError) as error:
+        print(error)
+    else:
+        print(f"Deleted {deleted} stale user verifications")
+    finally:
+        if connection:
+            connection.close()
+
+
+@manager.command
+def calibrate_hash(target_ms=250):
+    """Recommend PASSWORD_HASH_ITERATIONS for the target ms per hash"""
+
+    sample_iterations = 20000
+    timings = []
+    for _ in range(5):
+        start = time.perf_counter()
+        generate_hash("calibration-password", sample_iterations)
+        timings.append(time.perf_counter() - start)
+
+    per_iteration_ms = min(timings) * 1000 / sample_iterations
+    recommended = int(float(target_ms) / per_iteration_ms) // 1000 * 1000
+    recommended = max(recommended, 1000)
+    current_ms = per_iteration_ms * settings.PASSWORD_HASH_ITERATIONS
+    print(
+        f"Current cost {settings.PASSWORD_HASH_ITERATIONS} iterations "
+        f"takes ~{current_ms:.1f} ms per hash on this host"
+    )
+    print(f"PASSWORD_HASH_ITERATIONS={recommended}")
+
+
+@manager.command
+def consume_deposits(consumer=None):
+    """Apply the deposits queued by the webhook in stream ingestion mode"""
+    from main import get_redis_pool
+    from payment.consumer import consume_deposits as consume
+
+    async def run():
+        database = Database(settings.connection)
+        pool = get_redis_pool()
+        conn = Redis(connection_pool=pool)
+        await database.connect()
+        try:
+            await consume(database, conn, consumer)
+        finally:
+            await conn.close()
+            await pool.disconnect()
+            await database.disconnect()
+
+    try:
+        asyncio.run(run())
+    except KeyboardInterrupt:
+        print("Stopped")
+
+
+@manager.command
+def archive_transactions(months=12, directory="archive"):
+    """Detach the monthly transaction partitions older than months and
+    export them to gzip compressed NDJSON files in directory"""
+
+    os.makedirs(directory, exist_ok=True)
+    connection = None
+    try:
+        connection = psycopg2.connect(settings.connection)
+
+        cursor = connection.cursor()
+        cursor.execute(
+            """
+            SELECT child.relname
+            FROM pg_inherits
+            JOIN pg_class AS child ON child.oid = pg_inherits.inhrelid
+            JOIN pg_class AS parent ON parent.oid = pg_inherits.inhparent
+            WHERE parent.relname = 'transaction'
+                AND child.relname ~ '^transaction_p[0-9]{6}$'
+                AND to_date(substr(child.relname, 14), 'YYYYMM')
+                    < date_trunc('month', now()) - make_interval(months => %s)
+            ORDER BY child.relname
+            """,
+            (int(months),),
+        )
+        partitions = [row[0] for row in cursor.fetchall()]
+
+        for partition in partitions:
+            # Exported while still attached and written under a temporary
+            # name, a failed export leaves the partition in place
+            path = os.path.join(directory, f"{partition}.ndjson.gz")
+            exported = 0
+            with gzip.open(f"{path}.part", "wt", encoding="utf-8") as file:
+                rows = connection.cursor(name=f"export_{partition}")
+                rows.itersize = 10000
+                rows.execute(
+                    sql.SQL(
+                        "SELECT id, deposit, bill_id, created_at FROM {} "
+                        "ORDER BY created_at, id"
+                    ).format(sql.Identifier(partition))
+                )
+                for transaction_id, deposit, bill_id, created_at in rows:
+                    file.write(
+                        json.dumps(
+                            {
+                                "id": transaction_id,
+                                "deposit": deposit,
+                                "bill_id": bill_id,
+                                "created_at": created_at.isoformat(),
+                            }
+                        )
+                    )
+                    file.write("\n")
+                    exported += 1
+                rows.close()
+            connection.commit()
+            os.replace(f"{path}.part", path)
+
+            # transaction_key keeps the ids, so archived transactions
+            # that are retried are still not applied twice
+            cursor.execute(
+                sql.SQL("ALTER TABLE transaction DETACH PARTITION {}").format(
+                    sql.Identifier(partition)
+                )
+            )
+            cursor.execute(
+                sql.SQL("DROP TABLE {}").format(sql.Identifier(partition))
+            )
+            connection.commit()
+            print(
+                f"Archived {exported} transactions of {partition} to {path}"
+            )
+
+        cursor.close()
+    except (Exception, psycopg2.DatabaseError) as error:
+        print(error)
+    else:
+        print(f"Archived {len(partitions)} partitions")
+    finally:
+        if connection:
+            connection.close()
+
+
 if __name__ == "__main__":
     manager.main()
@@ -0,0 +1,204 @@
+import gzip
+import time
+from collections import defaultdict
+from typing import Dict, Optional, Tuple
+
+from sanic.request import Request
+from sanic.response import HTTPResponse
+
+import settings
+from metrics import register_metric
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+COMPRESSIBLE_TYPES = (
+    "application/json",
+    "application/x-ndjson",
+    "text/",
+)
+
+
+def supported_encodings() -> Tuple[str, ...]:
+    """Encodings in the order of preference of the server"""
+    if brotli is not None:
+        return ("br", "gzip")
+    return ("gzip",)
+
+
+def choose_encoding(request: Request) -> Optional[str]:
+    """Return the preferred encoding accepted by the client, if any"""
+    accept_encoding = request.headers.get("Accept-Encoding")
+    if not accept_encoding:
+        return None
+
+    accepted = {}
+    for item in accept_encoding.split(","):
+        coding, _, params = item.strip().partition(";")
+        quality = 1.0
+        params = params.strip()
+        if params.startswith("q="):
+            try:
+                quality = float(params[2:])
+            except ValueError:
+                quality = 0.0
+        accepted[coding.strip().lower()] = quality
+
+    best, best_quality = None, 0.0
+    for encoding in supported_encodings():
+        quality = accepted.get(encoding, accepted.get("*", 0.0))
+        if quality > best_quality:
+            best, best_quality = encoding, quality
+    return best
+
+
+def compress(body: bytes, encoding: str) -> bytes:
+    if encoding == "br":
+        return brotli.compress(body, quality=settings.COMPRESSION_BROTLI_LEVEL)
+    return gzip.compress(body, compresslevel=settings.COMPRESSION_GZIP_LEVEL)
+
+
+class CompressionStats:
+    """Bytes saved and CPU time spent on compression per route"""
+
+    def __init__(self):
+        self._routes = defaultdict(
+            lambda: {
+                "responses": 0,
+                "compressed": 0,
+                "bytes_in": 0,
+                "bytes_out": 0,
+                "cpu_ms": 0.0,
+            }
+        )
+
+    def record(
+        self,
+        route: str,
+        bytes_in: int,
+        bytes_out: int,
+        cpu_time: float = 0.0,
+        compressed: bool = True,
+    ):
+        stats = self._routes[route]
+        stats["responses"] += 1
+        stats["compressed"] += compressed
+        stats["bytes_in"] += bytes_in
+        stats["bytes_out"] += bytes_out
+        stats["cpu_ms"] += cpu_time * 1000
+
+    def stats(self) -> dict:
+        return {
+            route: {
+                **stats,
+                "bytes_saved": stats["bytes_in"] - stats["bytes_out"],
+                "cpu_ms": round(stats["cpu_ms"], 3),
+            }
+            for route, stats in self._routes.items()
+        }
+
+
+compression_stats = CompressionStats()
+register_metric("compression", compression_stats.stats)
+
+
+def _route_name(request: Request) -> str:
+    return request.name or "unrouted"
+
+
+def _timed_compress(body: bytes, encoding: str) -> Tuple[bytes, float]:
+    started = time.thread_time()
+    compressed = compress(body, encoding)
+    return compressed, time.thread_time() - started
+
+
+def cached_encoding(request: Request, body: bytes) -> Optional[str]:
+    """Encoding encode_cached will use, known before compressing, e.g.
+    to answer 304 to the variant ETag"""
+    if not settings.COMPRESSION_ENABLED:
+        return None
+    if len(body) < settings.COMPRESSION_MIN_SIZE:
+        return None
+    return choose_encoding(request)
+
+
+def encode_cached(
+    request: Request, body: bytes, variants: Dict[str, bytes]
+) -> Tuple[bytes, Optional[str]]:
+    """Return body in the encoding accepted by the client and the encoding.
+
+    Compressed bodies are kept in variants, so a cacheable body is
+    compressed only once per encoding. Call it only for a body that is
+    sent, it records the compression stats.
+    """
+    encoding = cached_encoding(request, body)
+    if encoding is None:
+        return body, None
+
+    cpu_time = 0.0
+    compressed = variants.get(encoding)
+    if compressed is None:
+        compressed, cpu_time = _timed_compress(body, encoding)
+        variants[encoding] = compressed
+    compression_stats.record(
+        _route_name(request), len(body), len(compressed), cpu_time
+    )
+    return compressed, encoding
+
+
+def variant_etag(etag: str, encoding: Optional[str]) -> str:
+    """ETag of the encoded representation of a body with the given etag"""
+    if encoding is None:
+        return etag
+    return f'{etag[:-1]}-{encoding}"'
+
+
+def _add_vary(response: HTTPResponse):
+    vary = response.headers.get("Vary")
+    if not vary:
+        response.headers["Vary"] = "Accept-Encoding"
+    elif "accept-encoding" not in vary.lower():
+        response.headers["Vary"] = f"{vary}, Accept-Encoding"
+
+
+async def compress_response(request: Request, response: HTTPResponse):
+    """Response middleware compressing buffered textual bodies"""
+    if not settings.COMPRESSION_ENABLED:
+        return
+    # Empty bodies include streamed responses, the middleware runs before
+    # any of their body is sent
+    if not response.body or "Content-Encoding" in response.headers:
+        return
+    content_type = response.content_type or ""
+    if not content_type.startswith(COMPRESSIBLE_TYPES):
+        return
+
+    _add_vary(response)
+    if len(response.body) < settings.COMPRESSION_MIN_SIZE:
+        return
+    encoding = choose_encoding(request)
+    if encoding is None:
+        return
+
+    body, cpu_time = _timed_compress(response.body, encoding)
+    if len(body) >= len(response.body):
+        compression_stats.record(
+            _route_name(request),
+            len(response.body),
+            len(response.body),
+            cpu_time,
+            compressed=False,
+        )
+        return
+
+    compression_stats.record(
+        _route_name(request), len(response.body), len(body), cpu_time
+    )
+    response.body = body
+    response.headers["Content-Encoding"] = encoding
+    if "ETag" in response.headers:
+        response.headers["ETag"] = variant_etag(
+            response.headers["ETag"], encoding
+        )
@@ -1,14 +1,16 @@
 from _socket import gaierror
 from databases import Database
-from redis import ConnectionPool
+from redis.asyncio import ConnectionPool, Redis
 from sanic import Sanic
 from sanic_openapi import openapi3_blueprint
-from sanic_session import Session
 from sqlalchemy import MetaData
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import DeclarativeMeta
 
 import settings
+from cache import listen_for_invalidations
+from compression import compress_response
+from sessions import get_session_interface
 
 # dictConfig(settings.LOGGER_SETTINGS)
 
@@ -20,6 +22,8 @@ if not settings.SECRET_KEY:
 
 app.config["SECRET_KEY"] = settings.SECRET_KEY
 
+app.register_middleware(compress_response, "response")
+
 mainmetatadata: MetaData = MetaData()
 Base: DeclarativeMeta = declarative_base(metadata=mainmetatadata)
 
@@ -41,9 +45,124 @@ async def disconnect_db(app, loop):
     await app.config["database"].disconnect()
 
 
-def get_redis_pool(redis_db=0):
+@app.listener("before_server_start")
+async def connect_redis(app, loop):
+    app.config["redis_pool"] = None
+    app.config["redis"] = None
+    app.config["redis_pubsub"] = None
+    if app.config["REDIS_USE"]:
+        app.config["redis_pool"] = get_redis_pool(app.config["REDIS_DB"])
+        app.config["redis"] = Redis(connection_pool=app.config["redis_pool"])
+        # Subscribers wait for messages indefinitely, so they get their own
+        # connection without the socket timeout of the command pool
+        app.config["redis_pubsub"] = Redis(
+            connection_pool=get_redis_pool(
+                app.config["REDIS_DB"], socket_timeout=None, max_connections=1
+            )
+        )
+
+
+@app.listener("after_server_start")
+async def start_invalidation_listener(app, loop):
+    if app.config["redis"]:
+        app.add_task(
+            listen_for_invalidations(app), name="invalidation_listener"
+        )
+
+
+@app.listener("after_server_start")
+async def start_revocation_sync(app, loop):
+    if app.config["redis"] and settings.TOKEN_MODE == "stateless":
+        from users.auth import sync_revoked_tokens
+
+        app.add_task(sync_revoked_tokens(app), name="revocation_sync")
+
+
+@app.listener("after_server_start")
+async def start_verification_cleanup(app, loop):
+    if settings.VERIFICATION_CLEANUP_INTERVAL > 0:
+        from users.utils import cleanup_user_verifications
+
+        app.add_task(
+            cleanup_user_verifications(app), name="verification_cleanup"
+        )
+
+
+@app.listener("before_server_stop")
+async def stop_verification_cleanup(app, loop):
+    await app.cancel_task("verification_cleanup", raise_exception=False)
+
+
+@app.listener("after_server_start")
+async def start_transaction_partitions(app, loop):
+    if settings.TRANSACTION_PARTITION_INTERVAL > 0:
+        from payment.utils import maintain_transaction_partitions
+
+        app.add_task(
+            maintain_transaction_partitions(app), name="transaction_partitions"
+        )
+
+
+@app.listener("before_server_stop")
+async def stop_transaction_partitions(app, loop):
+    await app.cancel_task("transaction_partitions", raise_exception=False)
+
+
+@app.listener("after_server_start")
+async def start_username_filter(app, loop):
+    from users.utils import refresh_username_filter
+
+    app.add_task(refresh_username_filter(app), name="username_filter")
+
+
+@app.listener("before_server_stop")
+async def stop_username_filter(app, loop):
+    await app.cancel_task("username_filter", raise_exception=False)
+
+
+@app.listener("after_server_start")
+async def start_deposit_consumer(app, loop):
+    if (
+        app.config["redis"]
+        and settings.WEBHOOK_INGESTION == "stream"
+        and settings.DEPOSIT_CONSUMER_IN_APP
+    ):
+        from payment.consumer import run_deposit_consumer
+
+        app.add_task(run_deposit_consumer(app), name="deposit_consumer")
+
+
+@app.listener("before_server_stop")
+async def disconnect_redis(app, loop):
+    if app.config["redis_pool"]:
+        await app.cancel_task("invalidation_listener", raise_exception=False)
+        await app.cancel_task("revocation_sync", raise_exception=False)
+        await app.cancel_task("deposit_consumer", raise_exception=False)
+        await app.config["redis"].close()
+        await app.config["redis_pool"].disconnect()
+        await app.config["redis_pubsub"].close()
+        await app.config["redis_pubsub"].connection_pool.disconnect()
+
+
+@app.listener("before_server_stop")
+async def stop_hash_executor(app, loop):
+    from users.utils import shutdown_hash_executor
+
+    shutdown_hash_executor()
+
+
+def get_redis_pool(
+    redis_db=0,
+    socket_timeout=settings.REDIS_SOCKET_TIMEOUT,
+    max_connections=settings.REDIS_MAX_CONNECTIONS,
+):
     return ConnectionPool(
-        host=settings.REDIS_HOST, port=settings.REDIS_PORT, db=redis_db
+        host=settings.REDIS_HOST,
+        port=settings.REDIS_PORT,
+        db=redis_db,
+        max_connections=max_connections,
+        socket_timeout=socket_timeout,
+        socket_connect_timeout=settings.REDIS_SOCKET_CONNECT_TIMEOUT,
     )
 
 
@@ -51,9 +170,10 @@ def create_app(
     connection, run=True, force_rollback=False, redis_use=True, redis_db=0
 ):
 
-    Session(app)
+    app.config["REDIS_USE"] = redis_use
+    app.config["REDIS_DB"] = redis_db
 
-    app.config["redis_pool"] = get_redis_pool(redis_db) if redis_use else None
+    app.ctx.session_interface = get_session_interface(app)
     app.config["CONNECTION"] = connection
     app.config["FORCE_ROLLBACK"] = force_rollback
 
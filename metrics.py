@@ -0,0 +1,12 @@
+from typing import Callable, Dict
+
+_collectors: Dict[str, Callable[[], dict]] = {}
+
+
+def register_metric(name: str, collector: Callable[[], dict]):
+    """Expose collector() output under name on the admin metrics route"""
+    _collectors[name] = collector
+
+
+def collect_metrics() -> dict:
+    return {name: collector() for name, collector in _collectors.items()}
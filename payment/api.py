@@ -1,26 +1,77 @@
-from Crypto.Hash import SHA1
 from sanic import Blueprint, Request, response
 from sanic_openapi.openapi3 import openapi
 from sanic_validation import validate_json
 
 import settings
-from payment.json_responses import (ReceiveBillsInfoResponse200,
+from payment.consumer import enqueue_deposits
+from payment.json_responses import (BillTransactionsResponse200,
+                                    BillTransactionsResponse400,
+                                    BillTransactionsResponse404,
+                                    ReceiveBillsInfoResponse200,
+                                    WebhookBatchResponse200,
                                     WebhookResponse200, WebhookResponse201,
-                                    WebhookResponse404, WebhookResponse406,
+                                    WebhookResponse202, WebhookResponse404,
+                                    WebhookResponse406, WebhookResponse409,
                                     WebhookResponse428)
-from payment.json_validators import WebhookRequestBody, webhook_schema
-from payment.utils import create_bill, create_transaction, get_bill
-from payment.webhook import webhook_db_transaction
+from payment.json_validators import (WebhookBatchRequestBody,
+                                     WebhookRequestBody, webhook_batch_schema,
+                                     webhook_schema)
+from payment.utils import (get_bill, get_transactions_page,
+                           parse_transactions_args)
+from payment.webhook import (BILL_CREATED, BILL_NOT_FOUND, CONFLICT,
+                             USER_NOT_FOUND, apply_deposits,
+                             get_seen_deposit_outcomes,
+                             remember_deposit_outcomes, sign_deposit,
+                             webhook_db_transaction)
+from streaming import requested_stream_format, stream_json
 from users.auth import login_required
 from users.json_responses import UnauthorizedResponse401
-from users.models import User
-from users.utils import get_user_by_id
+from users.utils import Principal, get_principal
+from validation import INT32_MAX, validate_bulk_items
 
 payment_blueprint = Blueprint("payment", url_prefix="api/")
 
 
+def deposit_outcome_response(outcome: str):
+    if outcome == BILL_CREATED:
+        return response.json(
+            {
+                "message": "The payment was completed successfully, the bill was created"
+            },
+            status=201,
+        )
+    if outcome == CONFLICT:
+        return response.json(
+            {
+                "error": "The transaction id was already used for another deposit"
+            },
+            status=409,
+        )
+    if outcome == BILL_NOT_FOUND:
+        return response.json({"error": "The bill was not found"}, status=404)
+    if outcome == USER_NOT_FOUND:
+        return response.json({"error": "The user was not found"}, status=404)
+    return response.json(
+        {"message": "The payment was completed successfully"}, status=200
+    )
+
+
+def bill_to_dict(bill) -> dict:
+    last_transaction_at = bill.last_transaction_at
+    return {
+        "id": bill.id,
+        "balance": bill.balance,
+        "last_transaction_at": last_transaction_at.isoformat()
+        if last_transaction_at
+        else None,
+    }
+
+
 @openapi.summary("Bills info")
-@openapi.description("Get detailed information about your bills")
+@openapi.description(
+    "Get the balance of your bills, the transactions of a bill are "
+    "listed by /bills/<bill_id>/transactions"
+)
 @openapi.tag("Payment")
 @openapi.parameter(
     "Authorization",
@@ -29,6 +80,14 @@ payment_blueprint = Blueprint("payment", url_prefix="api/")
     required=True,
     description="Bearer Token",
 )
+@openapi.parameter(
+    "stream",
+    bool,
+    location="query",
+    description=(
+        "Stream the bills, send Accept: application/x-ndjson for NDJSON"
+    ),
+)
 @openapi.response(
     200,
     {"application/json": ReceiveBillsInfoResponse200},
@@ -41,48 +100,109 @@ payment_blueprint = Blueprint("payment", url_prefix="api/")
     "/receive-bills-info", name="receive-bills-info", methods=("GET",)
 )
 @login_required(insert_user=True)
-async def receive_bills_info(request: Request, user: User):
+async def receive_bills_info(request: Request, user: Principal):
     query = """
-               SELECT bill.id, bill.balance,
-                   array_agg(transaction.id) AS transaction_id,
-                   array_agg(transaction.deposit) AS deposit,
-                   array_agg(transaction.created_at) AS created_at
+               SELECT bill.id, bill.balance, last_transaction.created_at
+                   AS last_transaction_at
                FROM bill
-               LEFT JOIN transaction
-                   ON transaction.bill_id = bill.id
+               LEFT JOIN LATERAL (
+                   SELECT created_at FROM transaction
+                   WHERE transaction.bill_id = bill.id
+                   ORDER BY created_at DESC, id DESC
+                   LIMIT 1
+               ) AS last_transaction ON TRUE
                WHERE bill.user_id = :user_id
-               GROUP by bill.id
                ORDER BY bill.id;
             """
     database = request.app.config["database"]
-    bills = await database.fetch_all(query=query, values={"user_id": user.id})
+    values = {"user_id": user.id}
+
+    stream_format = requested_stream_format(request)
+    if stream_format:
+        await stream_json(
+            request,
+            "bills",
+            database.iterate(query=query, values=values),
+            bill_to_dict,
+            stream_format,
+        )
+        return
 
-    data = []
+    bills = await database.fetch_all(query=query, values=values)
+    result = {"bills": [bill_to_dict(bill) for bill in bills]}
 
-    for bill in bills:
-        transactions = []
+    return response.json(result, status=200)
 
-        if bill.transaction_id[0]:
-            for i in range(len(bill.transaction_id)):
-                transactions.append(
-                    {
-                        "id": bill.transaction_id[i],
-                        "deposit": bill.deposit[i],
-                        "created_at": bill.created_at[i].isoformat(),
-                    }
-                )
 
-        data.append(
-            {
-                "id": bill.id,
-                "balance": bill.balance,
-                "transactions": transactions,
-            }
-        )
+@openapi.summary("Bill transactions")
+@openapi.description("Transactions of your bill, newest first")
+@openapi.tag("Payment")
+@openapi.parameter(
+    "Authorization",
+    str,
+    location="header",
+    required=True,
+    description="Bearer Token",
+)
+@openapi.parameter(
+    "after", str, location="query", description="next value of the last page"
+)
+@openapi.parameter(
+    "limit", int, location="query", description="Transactions per page"
+)
+@openapi.parameter(
+    "from",
+    str,
+    location="query",
+    description="ISO 8601 date or datetime, inclusive",
+)
+@openapi.parameter(
+    "to",
+    str,
+    location="query",
+    description="ISO 8601 date or datetime, exclusive",
+)
+@openapi.response(
+    200,
+    {"application/json": BillTransactionsResponse200},
+    "Successful Response",
+)
+@openapi.response(
+    400,
+    {"application/json": BillTransactionsResponse400},
+    "Bad Request Error",
+)
+@openapi.response(
+    401, {"application/json": UnauthorizedResponse401}, "Unauthorized Error"
+)
+@openapi.response(
+    404, {"application/json": BillTransactionsResponse404}, "Not Found"
+)
+@payment_blueprint.route(
+    "/bills/<bill_id:int>/transactions",
+    name="bill-transactions",
+    methods=("GET",),
+)
+@login_required(insert_user=True)
+async def bill_transactions(request: Request, user: Principal, bill_id: int):
+    try:
+        page = parse_transactions_args(request.args)
+    except ValueError as error:
+        return response.json({"error": str(error)}, status=400)
 
-    result = {"bills": data}
+    database = request.app.config["database"]
+    # Ids outside the INTEGER column can't exist, and would overflow it
+    if not 0 < bill_id <= INT32_MAX or not await get_bill(
+        database, bill_id, user.id
+    ):
+        return response.json({"error": "The bill was not found"}, status=404)
 
-    return response.json(result, status=200)
+    transactions, next_cursor = await get_transactions_page(
+        database, bill_id, page
+    )
+    return response.json(
+        {"transactions": transactions, "next": next_cursor}, status=200
+    )
 
 
 @openapi.summary("Payment webhook")
@@ -108,6 +228,11 @@ async def receive_bills_info(request: Request, user: User):
 @openapi.response(
     201, {"application/json": WebhookResponse201}, "Successful Response"
 )
+@openapi.response(
+    202,
+    {"application/json": WebhookResponse202},
+    "Accepted Response, when deposits are ingested through a stream",
+)
 @openapi.response(
     401, {"application/json": UnauthorizedResponse401}, "Unauthorized Error"
 )
@@ -117,14 +242,17 @@ async def receive_bills_info(request: Request, user: User):
 @openapi.response(
     406, {"application/json": WebhookResponse406}, "Not Acceptable Response"
 )
+@openapi.response(
+    409, {"application/json": WebhookResponse409}, "Conflict Response"
+)
 @openapi.response(
     428,
     {"application/json": WebhookResponse428},
     "Precondition Required Response",
 )
 @payment_blueprint.route("/payment/webhook", name="webhook", methods=("POST",))
-@login_required()
 @validate_json(webhook_schema)
+@login_required()
 async def webhook(request: Request):
     database = request.app.config["database"]
     signature = request.json.get("signature")
@@ -132,42 +260,122 @@ async def webhook(request: Request):
     user_id = request.json.get("user_id")
     bill_id = request.json.get("bill_id")
     amount = request.json.get("amount")
-    correct_signature = SHA1.new(
-        f"{settings.private_key}:{transaction_id}:{user_id}:{bill_id}:{amount}".encode()
-    ).hexdigest()
-    print(correct_signature)
-    if signature == correct_signature:
-        if await get_user_by_id(database, user_id):
-            if amount > 0:
-                if await get_bill(database, bill_id, user_id):
-                    await webhook_db_transaction(
-                        bill_id, transaction_id, amount
-                    )
-                    return response.json(
-                        {"message": "The payment was completed successfully"},
-                        status=200,
-                    )
-                else:
-                    await create_bill(database, bill_id, amount, user_id)
-                    await create_transaction(
-                        database, bill_id, transaction_id, amount
-                    )
-                    return response.json(
-                        {
-                            "message": "The payment was completed successfully, the bill was created"
-                        },
-                        status=201,
-                    )
-            else:
-                return response.json(
-                    {"error": "The amount must be a positive number"},
-                    status=428,
-                )
-        else:
-            return response.json(
-                {"error": "The user was not found"}, status=404
-            )
-    else:
+    correct_signature = sign_deposit(request.json)
+    if signature != correct_signature:
         return response.json(
             {"error": "The signature is incorrect"}, status=406
         )
+    if amount <= 0:
+        return response.json(
+            {"error": "The amount must be a positive number"}, status=428
+        )
+
+    # Retries of recently applied deposits are answered from redis
+    conn = request.app.config["redis"]
+    (outcome,) = await get_seen_deposit_outcomes(conn, [request.json])
+    if outcome:
+        return deposit_outcome_response(outcome)
+
+    if settings.WEBHOOK_INGESTION == "stream":
+        await enqueue_deposits(conn, [request.json])
+        return response.json(
+            {
+                "message": "The payment was accepted and will be applied shortly"
+            },
+            status=202,
+        )
+
+    if not await get_principal(database, user_id):
+        return deposit_outcome_response(USER_NOT_FOUND)
+
+    outcome = await webhook_db_transaction(
+        database, user_id, bill_id, transaction_id, amount
+    )
+    await remember_deposit_outcomes(conn, [request.json], [outcome])
+    return deposit_outcome_response(outcome)
+
+
+@openapi.summary("Payment webhook batch")
+@openapi.description(
+    "Settle many deposits in one request. Signatures are checked before "
+    "anything is applied, the valid deposits are applied in one database "
+    "transaction, or queued in stream ingestion mode, and a result is "
+    "returned for every item"
+)
+@openapi.tag("Payment")
+@openapi.parameter(
+    "Authorization",
+    str,
+    location="header",
+    required=True,
+    description="Bearer Token",
+)
+@openapi.body(
+    {"application/json": WebhookBatchRequestBody},
+    description="",
+    required=True,
+)
+@openapi.response(
+    200, {"application/json": WebhookBatchResponse200}, "Successful Response"
+)
+@openapi.response(
+    401, {"application/json": UnauthorizedResponse401}, "Unauthorized Error"
+)
+@payment_blueprint.route(
+    "/payment/webhook/batch", name="webhook-batch", methods=("POST",)
+)
+@validate_json(webhook_batch_schema)
+@login_required()
+async def webhook_batch(request: Request):
+    deposits = request.json.get("deposits")
+    valid, errors = validate_bulk_items(deposits, webhook_schema)
+
+    results = [None] * len(deposits)
+    for index, item_errors in errors.items():
+        results[index] = {
+            "index": index,
+            "status": "invalid",
+            "errors": item_errors,
+        }
+
+    signed = []
+    for index in valid:
+        deposit = deposits[index]
+        if deposit["signature"] != sign_deposit(deposit):
+            status = "invalid_signature"
+        elif deposit["amount"] <= 0:
+            status = "invalid_amount"
+        else:
+            signed.append(index)
+            continue
+        results[index] = {
+            "index": index,
+            "transaction_id": deposit["transaction_id"],
+            "status": status,
+        }
+
+    # Retries of recently applied deposits are answered from redis
+    conn = request.app.config["redis"]
+    seen = await get_seen_deposit_outcomes(
+        conn, [deposits[index] for index in signed]
+    )
+    pending = [index for index, outcome in zip(signed, seen) if not outcome]
+    outcomes = dict(zip(signed, seen))
+
+    if pending and settings.WEBHOOK_INGESTION == "stream":
+        await enqueue_deposits(conn, [deposits[index] for index in pending])
+        outcomes.update((index, "queued") for index in pending)
+    elif pending:
+        items = [deposits[index] for index in pending]
+        applied = await apply_deposits(request.app.config["database"], items)
+        await remember_deposit_outcomes(conn, items, applied)
+        outcomes.update(zip(pending, applied))
+
+    for index, outcome in outcomes.items():
+        results[index] = {
+            "index": index,
+            "transaction_id": deposits[index]["transaction_id"],
+            "status": outcome,
+        }
+
+    return response.json({"results": results}, status=200)
@@ -0,0 +1,224 @@
+import asyncio
+import os
+import socket
+import time
+from typing import List, Tuple
+
+from databases import Database
+from redis.asyncio import Redis
+from redis.exceptions import ResponseError
+from sanic.log import logger
+
+import settings
+from metrics import register_metric
+from payment.webhook import apply_deposits, remember_deposit_outcomes
+
+DEPOSIT_FIELDS = ("transaction_id", "user_id", "bill_id", "amount")
+
+
+class ConsumerStats:
+    def __init__(self):
+        self.batches = 0
+        self.applied = 0
+        self.reclaimed = 0
+        self.failed_batches = 0
+        self.failed_entries = 0
+        self.dead_lettered = 0
+        self.last_batch_ms = 0.0
+        # Entries not delivered to the group yet and delivered but not acked
+        self.lag = None
+        self.pending = None
+
+    def stats(self) -> dict:
+        return dict(self.__dict__)
+
+
+consumer_stats = ConsumerStats()
+register_metric("deposit_consumer", consumer_stats.stats)
+
+
+def default_consumer_name() -> str:
+    return f"{socket.gethostname()}-{os.getpid()}"
+
+
+async def enqueue_deposits(conn: Redis, deposits: List[dict]) -> List[str]:
+    """Append signed deposits to the stream, return their entry ids"""
+    pipe = conn.pipeline(transaction=False)
+    for deposit in deposits:
+        pipe.xadd(
+            settings.DEPOSIT_STREAM,
+            {field: deposit[field] for field in DEPOSIT_FIELDS},
+            maxlen=settings.DEPOSIT_STREAM_MAXLEN,
+            approximate=True,
+        )
+    entry_ids = await pipe.execute()
+    return [entry_id.decode() for entry_id in entry_ids]
+
+
+async def ensure_consumer_group(conn: Redis):
+    try:
+        await conn.xgroup_create(
+            settings.DEPOSIT_STREAM,
+            settings.DEPOSIT_CONSUMER_GROUP,
+            id="0",
+            mkstream=True,
+        )
+    except ResponseError as error:
+        if "BUSYGROUP" not in str(error):
+            raise
+
+
+def _parse_entries(entries) -> Tuple[list, list, list]:
+    """Return ids and deposits of the valid entries and ids of the rest"""
+    entry_ids, deposits, malformed = [], [], []
+    for entry_id, fields in entries:
+        try:
+            deposits.append(
+                {
+                    field: int(fields[field.encode()])
+                    for field in DEPOSIT_FIELDS
+                }
+            )
+        except (KeyError, ValueError):
+            malformed.append(entry_id)
+        else:
+            entry_ids.append(entry_id)
+    return entry_ids, deposits, malformed
+
+
+async def _ack(conn: Redis, *entry_ids):
+    await conn.xack(
+        settings.DEPOSIT_STREAM, settings.DEPOSIT_CONSUMER_GROUP, *entry_ids
+    )
+
+
+async def _apply(database: Database, conn: Redis, entry_ids, deposits):
+    outcomes = await apply_deposits(database, deposits)
+    await remember_deposit_outcomes(conn, deposits, outcomes)
+    # Entries are acked only after the deposits were committed
+    await _ack(conn, *entry_ids)
+    consumer_stats.applied += len(deposits)
+
+
+async def _times_delivered(conn: Redis, entry_id) -> int:
+    pending = await conn.xpending_range(
+        settings.DEPOSIT_STREAM,
+        settings.DEPOSIT_CONSUMER_GROUP,
+        min=entry_id,
+        max=entry_id,
+        count=1,
+    )
+    return pending[0]["times_delivered"] if pending else 0
+
+
+async def _dead_letter(conn: Redis, entry_id, deposit: dict, error: str):
+    await conn.xadd(
+        settings.DEPOSIT_DEAD_LETTER_STREAM,
+        {**deposit, "entry_id": entry_id, "error": error},
+    )
+    await _ack(conn, entry_id)
+    consumer_stats.dead_lettered += 1
+
+
+async def _apply_one_by_one(
+    database: Database, conn: Redis, entry_ids, deposits
+):
+    """Isolate the entries that make a batch fail.
+
+    A failing entry stays pending and is reclaimed after
+    DEPOSIT_CLAIM_IDLE_MS, after DEPOSIT_MAX_DELIVERIES deliveries it is
+    moved to the dead letter stream so it can't block the others forever.
+    """
+    for entry_id, deposit in zip(entry_ids, deposits):
+        try:
+            await _apply(database, conn, [entry_id], [deposit])
+        except asyncio.CancelledError:
+            raise
+        except Exception as error:
+            consumer_stats.failed_entries += 1
+            delivered = await _times_delivered(conn, entry_id)
+            if delivered >= settings.DEPOSIT_MAX_DELIVERIES:
+                logger.exception(
+                    f"Moving deposit entry {entry_id} to the dead letter "
+                    f"stream after {delivered} deliveries"
+                )
+                await _dead_letter(conn, entry_id, deposit, repr(error))
+            else:
+                logger.exception(f"Can't apply deposit entry {entry_id}")
+
+
+async def _apply_entries(database: Database, conn: Redis, entries):
+    entry_ids, deposits, malformed = _parse_entries(entries)
+    if malformed:
+        logger.error(f"Dropping malformed deposit entries {malformed}")
+        await _ack(conn, *malformed)
+    if not deposits:
+        return
+
+    started = time.perf_counter()
+    try:
+        await _apply(database, conn, entry_ids, deposits)
+    except asyncio.CancelledError:
+        raise
+    except Exception:
+        consumer_stats.failed_batches += 1
+        logger.exception("Deposit batch failed, applying it entry by entry")
+        await _apply_one_by_one(database, conn, entry_ids, deposits)
+    consumer_stats.batches += 1
+    consumer_stats.last_batch_ms = (time.perf_counter() - started) * 1000
+
+
+async def _reclaim_entries(conn: Redis, consumer: str):
+    """Take over entries other consumers read but didn't ack in time"""
+    result = await conn.xautoclaim(
+        settings.DEPOSIT_STREAM,
+        settings.DEPOSIT_CONSUMER_GROUP,
+        consumer,
+        min_idle_time=settings.DEPOSIT_CLAIM_IDLE_MS,
+        start_id="0-0",
+        count=settings.DEPOSIT_BATCH_SIZE,
+    )
+    # Deleted entries are returned with empty fields
+    return [entry for entry in result[1] if entry[1]]
+
+
+async def _update_lag(conn: Redis):
+    for group in await conn.xinfo_groups(settings.DEPOSIT_STREAM):
+        if group["name"].decode() == settings.DEPOSIT_CONSUMER_GROUP:
+            # lag is reported by redis 7 and newer
+            consumer_stats.lag = group.get("lag")
+            consumer_stats.pending = group["pending"]
+
+
+async def consume_deposits(
+    database: Database, conn: Redis, consumer: str = None
+):
+    """Apply the deposits of the stream in batches until cancelled"""
+    consumer = consumer or default_consumer_name()
+    await ensure_consumer_group(conn)
+    while True:
+        try:
+            entries = await _reclaim_entries(conn, consumer)
+            if entries:
+                consumer_stats.reclaimed += len(entries)
+            else:
+                response = await conn.xreadgroup(
+                    settings.DEPOSIT_CONSUMER_GROUP,
+                    consumer,
+                    {settings.DEPOSIT_STREAM: ">"},
+                    count=settings.DEPOSIT_BATCH_SIZE,
+                    block=settings.DEPOSIT_BLOCK_MS,
+                )
+                entries = response[0][1] if response else []
+            if entries:
+                await _apply_entries(database, conn, entries)
+            await _update_lag(conn)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            logger.exception("Deposit consumer failed, retrying")
+            await asyncio.sleep(1)
+
+
+async def run_deposit_consumer(app):
+    await consume_deposits(app.config["database"], app.config["redis"])
@@ -1,5 +1,31 @@
 class ReceiveBillsInfoResponse200:
-    bills = "data list"
+    bills = [
+        {
+            "id": 123456,
+            "balance": 100,
+            "last_transaction_at": "2022-09-01T12:30:00.000000",
+        }
+    ]
+
+
+# bills/<bill_id>/transactions
+class BillTransactionsResponse200:
+    transactions = [
+        {
+            "id": 1234567,
+            "deposit": 100,
+            "created_at": "2022-09-01T12:30:00.000000",
+        }
+    ]
+    next = "2022-09-01T12:30:00.000000:1234567"
+
+
+class BillTransactionsResponse400:
+    error = "limit must be between 1 and 500"
+
+
+class BillTransactionsResponse404:
+    error = "The bill was not found"
 
 
 # payment/webhook
@@ -11,6 +37,10 @@ class WebhookResponse201:
     message = "The payment was completed successfully, the bill was created"
 
 
+class WebhookResponse202:
+    message = "The payment was accepted and will be applied shortly"
+
+
 class WebhookResponse404:
     error = "The user was not found"
 
@@ -19,5 +49,19 @@ class WebhookResponse406:
     error = "The signature is incorrect"
 
 
+class WebhookResponse409:
+    error = "The transaction id was already used for another deposit"
+
+
 class WebhookResponse428:
     error = "The amount must be a positive number"
+
+
+# payment/webhook/batch
+class WebhookBatchResponse200:
+    results = [
+        {"index": 0, "transaction_id": 1234567, "status": "deposited"},
+        {"index": 1, "transaction_id": 1234568, "status": "bill_created"},
+        {"index": 2, "transaction_id": 1234569, "status": "queued"},
+        {"index": 3, "transaction_id": 1234570, "status": "invalid_signature"},
+    ]
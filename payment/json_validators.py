@@ -1,3 +1,6 @@
+import settings
+from validation import INT32_MAX
+
 signature_validation = {
     "type": "string",
     "required": True,
@@ -5,21 +8,29 @@ signature_validation = {
 
 transaction_id_validation = {
     "type": "integer",
+    "min": 1,
+    "max": INT32_MAX,
     "required": True,
 }
 
 user_id_validation = {
     "type": "integer",
+    "min": 1,
+    "max": INT32_MAX,
     "required": True,
 }
 
 bill_id_validation = {
     "type": "integer",
+    "min": 1,
+    "max": INT32_MAX,
     "required": True,
 }
 
+# Not positive amounts are reported separately by the webhook
 amount_validation = {
     "type": "integer",
+    "max": INT32_MAX,
     "required": True,
 }
 
@@ -31,6 +42,16 @@ webhook_schema = {
     "amount": amount_validation,
 }
 
+webhook_batch_schema = {
+    "deposits": {
+        "type": "list",
+        "required": True,
+        "minlength": 1,
+        "maxlength": settings.WEBHOOK_BATCH_MAX_SIZE,
+        "schema": {"type": "dict"},
+    }
+}
+
 
 class WebhookRequestBody:
     signature = "encrypted_string"
@@ -38,3 +59,15 @@ class WebhookRequestBody:
     user_id = 123
     bill_id = 123456
     amount = 100
+
+
+class WebhookBatchRequestBody:
+    deposits = [
+        {
+            "signature": "encrypted_string",
+            "transaction_id": 1234567,
+            "user_id": 123,
+            "bill_id": 123456,
+            "amount": 100,
+        }
+    ]
@@ -14,15 +14,39 @@ class Bill(Base):
 
 
 class Transaction(Base):
+    """Partitioned by month of created_at, see create_transaction_partitions"""
+
     __tablename__ = "transaction"
 
-    id = sa.Column(sa.types.INTEGER, primary_key=True)
+    id = sa.Column(sa.types.INTEGER, primary_key=True, autoincrement=False)
     deposit = sa.Column(sa.types.INTEGER, nullable=False)
     bill_id = sa.Column(sa.ForeignKey("bill.id"), nullable=False)
     created_at = sa.Column(
-        sa.types.DateTime, default=datetime.datetime.now, nullable=False
+        sa.types.DateTime,
+        default=datetime.datetime.now,
+        nullable=False,
+        primary_key=True,
+    )
+
+    __table_args__ = (
+        sa.Index(
+            "ix_transaction_bill_id_created_at_id",
+            "bill_id",
+            "created_at",
+            "id",
+        ),
+        {"postgresql_partition_by": "RANGE (created_at)"},
     )
 
 
+class TransactionKey(Base):
+    """Ids of every recorded transaction, unique across the partitions"""
+
+    __tablename__ = "transaction_key"
+
+    id = sa.Column(sa.types.INTEGER, primary_key=True, autoincrement=False)
+
+
 bill = Bill.__table__
 transaction = Transaction.__table__
+transaction_key = TransactionKey.__table__
@@ -1,47 +1,369 @@
+import asyncio
+import datetime
+from typing import Dict, List, NamedTuple, Optional, Set, Tuple
+
 from databases import Database
+from sanic.log import logger
+
+import settings
+from validation import INT32_MAX
 
 
 async def get_bill(database: Database, bill_id: int, user_id: int):
-    print("USER ID", user_id)
     query = "SELECT * FROM bill WHERE id = :bill_id AND user_id = :user_id"
     return await database.fetch_one(
         query=query, values={"bill_id": bill_id, "user_id": user_id}
     )
 
 
-async def update_bill_balance(
-    database: Database, bill_id: int, new_balance: int
+async def purchase_product(
+    database: Database, product_id: int, bill_id: int, user_id: int
 ):
-    query = "UPDATE bill SET balance = :new_balance WHERE id = :bill_id"
-    return await database.execute(
-        query=query, values={"bill_id": bill_id, "new_balance": new_balance}
+    """Charge the price of the product to the bill in one statement.
+
+    Return price (None if the product doesn't exist), bill_exists and the
+    new balance (None if nothing was charged). The balance condition is
+    rechecked on the locked row, so concurrent purchases can't overdraw
+    the bill.
+    """
+    query = """
+        WITH selected_product AS (
+            SELECT price FROM product WHERE id = :product_id
+        ), charged AS (
+            UPDATE bill SET balance = bill.balance - selected_product.price
+            FROM selected_product
+            WHERE bill.id = :bill_id
+                AND bill.user_id = :user_id
+                AND bill.balance >= selected_product.price
+            RETURNING bill.balance
+        )
+        SELECT
+            (SELECT price FROM selected_product) AS price,
+            EXISTS(
+                SELECT 1 FROM bill WHERE id = :bill_id AND user_id = :user_id
+            ) AS bill_exists,
+            (SELECT balance FROM charged) AS balance
+    """
+    return await database.fetch_one(
+        query=query,
+        values={
+            "product_id": product_id,
+            "bill_id": bill_id,
+            "user_id": user_id,
+        },
+    )
+
+
+# transaction partitions
+async def create_transaction_partitions(database: Database):
+    """Create the monthly partitions up to TRANSACTION_PARTITIONS_AHEAD
+    months from now, deposits of months without one go to the default"""
+    await database.execute(
+        query="SELECT create_transaction_partitions(:months_ahead)",
+        values={"months_ahead": settings.TRANSACTION_PARTITIONS_AHEAD},
+    )
+
+
+async def maintain_transaction_partitions(app):
+    """Periodically create the partitions of the coming months"""
+    while True:
+        try:
+            await create_transaction_partitions(app.config["database"])
+        except Exception:
+            logger.exception("Can't create transaction partitions")
+        await asyncio.sleep(settings.TRANSACTION_PARTITION_INTERVAL)
+
+
+# /bills/<bill_id>/transactions
+class TransactionsArgs(NamedTuple):
+    after: Optional[Tuple[datetime.datetime, int]]
+    date_from: Optional[datetime.datetime]
+    date_to: Optional[datetime.datetime]
+    limit: int
+
+
+def _parse_datetime(args, name: str) -> Optional[datetime.datetime]:
+    if not args.get(name):
+        return None
+    try:
+        value = datetime.datetime.fromisoformat(args.get(name))
+    except ValueError:
+        raise ValueError(f"{name} must be an ISO 8601 date or datetime")
+    # created_at is stored without a time zone
+    if value.tzinfo is not None:
+        raise ValueError(f"{name} must not have a time zone offset")
+    return value
+
+
+def parse_transactions_args(args) -> TransactionsArgs:
+    """Parse ?after=&from=&to=&limit= arguments"""
+    try:
+        limit = int(args.get("limit", settings.TRANSACTIONS_PAGE_SIZE))
+    except ValueError:
+        raise ValueError("limit must be an integer")
+    if not 0 < limit <= settings.TRANSACTIONS_MAX_PAGE_SIZE:
+        raise ValueError(
+            "limit must be between 1 and "
+            f"{settings.TRANSACTIONS_MAX_PAGE_SIZE}"
+        )
+
+    after = None
+    if args.get("after"):
+        try:
+            created_at, _, transaction_id = args.get("after").rpartition(":")
+            after = (
+                datetime.datetime.fromisoformat(created_at),
+                int(transaction_id),
+            )
+            if after[0].tzinfo is not None or not 0 < after[1] <= INT32_MAX:
+                raise ValueError
+        except ValueError:
+            raise ValueError("after must be the next value of the last page")
+
+    return TransactionsArgs(
+        after,
+        _parse_datetime(args, "from"),
+        _parse_datetime(args, "to"),
+        limit,
     )
 
 
+async def get_transactions_page(
+    database: Database, bill_id: int, page: TransactionsArgs
+) -> Tuple[List[dict], Optional[str]]:
+    """Return transactions of the bill, newest first, created in
+    [from, to) and the cursor of the next page"""
+    filters = ["bill_id = :bill_id"]
+    values = {"bill_id": bill_id, "limit": page.limit + 1}
+    if page.date_from is not None:
+        filters.append("created_at >= CAST(:date_from AS timestamp)")
+        values["date_from"] = page.date_from
+    if page.date_to is not None:
+        filters.append("created_at < CAST(:date_to AS timestamp)")
+        values["date_to"] = page.date_to
+    if page.after is not None:
+        # The plain created_at bound lets postgres skip newer partitions
+        filters.append(
+            "created_at <= CAST(:after_created_at AS timestamp) "
+            "AND (created_at, id) < "
+            "(CAST(:after_created_at AS timestamp), :after_id)"
+        )
+        values["after_created_at"], values["after_id"] = page.after
+
+    conditions = " AND ".join(filters)
+    query = f"""
+               SELECT id, deposit, created_at FROM transaction
+               WHERE {conditions}
+               ORDER BY created_at DESC, id DESC
+               LIMIT :limit
+            """
+    rows = await database.fetch_all(query=query, values=values)
+    transactions = [
+        {
+            "id": row["id"],
+            "deposit": row["deposit"],
+            "created_at": row["created_at"].isoformat(),
+        }
+        for row in rows[: page.limit]
+    ]
+    next_cursor = None
+    if len(rows) > page.limit:
+        last = transactions[-1]
+        next_cursor = f"{last['created_at']}:{last['id']}"
+    return transactions, next_cursor
+
+
 # /payment/webhook
-async def create_transaction(
-    database: Database, bill_id: int, transaction_id: int, deposit: int
-):
-    query = "INSERT INTO transaction(id, deposit, bill_id, created_at) VALUES (:transaction_id, :deposit, :bill_id, NOW())"
-    return await database.execute(
+async def create_bill_if_missing(
+    database: Database, bill_id: int, user_id: int
+) -> bool:
+    """Create an empty bill, return False if the bill already exists"""
+    query = """
+        INSERT INTO bill(id, balance, user_id) VALUES (:bill_id, 0, :user_id)
+        ON CONFLICT (id) DO NOTHING
+        RETURNING id
+    """
+    created = await database.fetch_val(
+        query=query, values={"bill_id": bill_id, "user_id": user_id}
+    )
+    return created is not None
+
+
+async def apply_deposit(
+    database: Database,
+    user_id: int,
+    bill_id: int,
+    transaction_id: int,
+    deposit: int,
+) -> bool:
+    """Record the transaction and add the deposit to the bill of the user.
+
+    Return False, without changing the balance, if the transaction was
+    already recorded or the bill belongs to another user.
+    """
+    query = """
+        WITH recorded AS (
+            INSERT INTO transaction_key(id)
+            SELECT CAST(:transaction_id AS integer)
+            WHERE EXISTS(
+                SELECT 1 FROM bill WHERE id = :bill_id AND user_id = :user_id
+            )
+            ON CONFLICT (id) DO NOTHING
+            RETURNING id
+        ), inserted AS (
+            INSERT INTO transaction(id, deposit, bill_id, created_at)
+            SELECT
+                id, CAST(:deposit AS integer), CAST(:bill_id AS integer), NOW()
+            FROM recorded
+            RETURNING deposit
+        )
+        UPDATE bill SET balance = bill.balance + inserted.deposit
+        FROM inserted
+        WHERE bill.id = :bill_id
+        RETURNING bill.balance
+    """
+    balance = await database.fetch_val(
         query=query,
         values={
+            "user_id": user_id,
             "bill_id": bill_id,
             "transaction_id": transaction_id,
             "deposit": deposit,
         },
     )
+    return balance is not None
 
 
-async def create_bill(
-    database: Database, bill_id: int, balance: int, user_id: int
-):
-    query = "INSERT INTO bill(id, balance, user_id) VALUES(:bill_id, :balance,:user_id)"
-    return await database.execute(
+async def get_recorded_deposit(database: Database, transaction_id: int):
+    """Return bill_id, deposit of a recorded transaction and whether it
+    was the first deposit of the bill, i.e. the one that created it"""
+    query = """
+        SELECT t.bill_id, t.deposit, NOT EXISTS(
+            SELECT 1 FROM transaction AS earlier
+            WHERE earlier.bill_id = t.bill_id
+                AND (earlier.created_at, earlier.id) < (t.created_at, t.id)
+        ) AS created_bill
+        FROM transaction AS t
+        WHERE t.id = :transaction_id
+    """
+    return await database.fetch_one(
+        query=query, values={"transaction_id": transaction_id}
+    )
+
+
+# /payment/webhook/batch
+async def get_existing_user_ids(
+    database: Database, user_ids: List[int]
+) -> Set[int]:
+    query = "SELECT id FROM users WHERE id = ANY(CAST(:user_ids AS integer[]))"
+    rows = await database.fetch_all(query=query, values={"user_ids": user_ids})
+    return {row["id"] for row in rows}
+
+
+async def create_missing_bills(
+    database: Database, bill_ids: List[int], user_ids: List[int]
+) -> Set[int]:
+    """Create empty bills, return the ids of the ones that didn't exist"""
+    query = """
+               INSERT INTO bill(id, balance, user_id)
+               SELECT DISTINCT ON (id) id, 0, user_id
+               FROM unnest(
+                   CAST(:bill_ids AS integer[]), CAST(:user_ids AS integer[])
+               ) AS item(id, user_id)
+               ON CONFLICT (id) DO NOTHING
+               RETURNING id
+            """
+    rows = await database.fetch_all(
+        query=query, values={"bill_ids": bill_ids, "user_ids": user_ids}
+    )
+    return {row["id"] for row in rows}
+
+
+async def bulk_apply_deposits(
+    database: Database, deposits: List[dict]
+) -> Set[int]:
+    """Record the transactions and add them to the bills of their users
+    with one grouped UPDATE, return the ids of the recorded transactions.
+
+    Transactions that were already recorded or target a bill of another
+    user are skipped.
+    """
+    query = """
+               WITH item AS (
+                   SELECT * FROM unnest(
+                       CAST(:ids AS integer[]),
+                       CAST(:deposits AS integer[]),
+                       CAST(:bill_ids AS integer[]),
+                       CAST(:user_ids AS integer[])
+                   ) WITH ORDINALITY
+                       AS item(id, deposit, bill_id, user_id, position)
+               ), recorded AS (
+                   INSERT INTO transaction_key(id)
+                   SELECT item.id
+                   FROM item
+                   JOIN bill
+                       ON bill.id = item.bill_id
+                       AND bill.user_id = item.user_id
+                   ORDER BY item.position
+                   ON CONFLICT (id) DO NOTHING
+                   RETURNING id
+               ), inserted AS (
+                   INSERT INTO transaction(id, deposit, bill_id, created_at)
+                   SELECT item.id, item.deposit, item.bill_id, NOW()
+                   FROM item
+                   JOIN recorded ON recorded.id = item.id
+                   ORDER BY item.position
+                   RETURNING id, bill_id, deposit
+               ), totals AS (
+                   SELECT bill_id, SUM(deposit) AS total
+                   FROM inserted
+                   GROUP BY bill_id
+               ), updated AS (
+                   UPDATE bill SET balance = bill.balance + totals.total
+                   FROM totals
+                   WHERE bill.id = totals.bill_id
+               )
+               SELECT id FROM inserted
+            """
+    rows = await database.fetch_all(
         query=query,
         values={
-            "bill_id": bill_id,
-            "balance": balance,
-            "user_id": user_id,
+            "ids": [item["transaction_id"] for item in deposits],
+            "deposits": [item["amount"] for item in deposits],
+            "bill_ids": [item["bill_id"] for item in deposits],
+            "user_ids": [item["user_id"] for item in deposits],
         },
     )
+    return {row["id"] for row in rows}
+
+
+async def delete_empty_bills(database: Database, bill_ids: List[int]):
+    """Delete the bills that have no transactions"""
+    query = """
+               DELETE FROM bill
+               WHERE id = ANY(CAST(:bill_ids AS integer[]))
+                   AND NOT EXISTS(
+                       SELECT 1 FROM transaction
+                       WHERE transaction.bill_id = bill.id
+                   )
+            """
+    await database.execute(query=query, values={"bill_ids": bill_ids})
+
+
+async def get_recorded_deposits(
+    database: Database, transaction_ids: List[int]
+) -> Dict[int, dict]:
+    """get_recorded_deposit of many transactions, keyed by id"""
+    query = """
+        SELECT t.id, t.bill_id, t.deposit, NOT EXISTS(
+            SELECT 1 FROM transaction AS earlier
+            WHERE earlier.bill_id = t.bill_id
+                AND (earlier.created_at, earlier.id) < (t.created_at, t.id)
+        ) AS created_bill
+        FROM transaction AS t
+        WHERE t.id = ANY(CAST(:transaction_ids AS integer[]))
+    """
+    rows = await database.fetch_all(
+        query=query, values={"transaction_ids": transaction_ids}
+    )
+    return {row["id"]: row for row in rows}
@@ -1,23 +1,195 @@
-import asyncpg
+import json
+from typing import List, Optional
+
+from Crypto.Hash import SHA1
+from databases import Database
+from redis.asyncio import Redis
 
 import settings
+from payment.utils import (apply_deposit, bulk_apply_deposits,
+                           create_bill_if_missing, create_missing_bills,
+                           delete_empty_bills, get_existing_user_ids,
+                           get_recorded_deposit, get_recorded_deposits)
+
+# Outcomes of a deposit, duplicates get the outcome of the first delivery
+DEPOSITED = "deposited"
+BILL_CREATED = "bill_created"
+# The transaction id was already used for another bill or amount
+CONFLICT = "conflict"
+# The bill belongs to another user
+BILL_NOT_FOUND = "bill_not_found"
+USER_NOT_FOUND = "user_not_found"
+
+
+class DuplicateTransaction(Exception):
+    """Raised inside the deposit transaction to roll back a created bill"""
+
+
+def sign_deposit(deposit: dict) -> str:
+    """Signature the payment provider sends with the deposit"""
+    return SHA1.new(
+        f"{settings.private_key}:{deposit['transaction_id']}:{deposit['user_id']}:{deposit['bill_id']}:{deposit['amount']}".encode()
+    ).hexdigest()
+
+
+def _outcome_of_recorded(recorded, bill_id: int, deposit: int) -> str:
+    if recorded["bill_id"] != bill_id or recorded["deposit"] != deposit:
+        return CONFLICT
+    return BILL_CREATED if recorded["created_bill"] else DEPOSITED
 
 
 async def webhook_db_transaction(
-    bill_id: int, transaction_id: int, deposit: int
-):
-    connection = await asyncpg.connect(settings.connection)
-
-    async with connection.transaction():
-        await connection.execute(
-            "INSERT INTO transaction(id, deposit, bill_id, created_at) VALUES ( $1, $2, $3, NOW())",
-            transaction_id,
-            deposit,
-            bill_id,
+    database: Database,
+    user_id: int,
+    bill_id: int,
+    transaction_id: int,
+    deposit: int,
+) -> str:
+    """Apply the deposit once per transaction_id and return its outcome"""
+    try:
+        # Runs on a pooled connection of the application database
+        async with database.transaction():
+            created = await create_bill_if_missing(database, bill_id, user_id)
+            if not await apply_deposit(
+                database, user_id, bill_id, transaction_id, deposit
+            ):
+                raise DuplicateTransaction
+    except DuplicateTransaction:
+        recorded = await get_recorded_deposit(database, transaction_id)
+        if not recorded:
+            return BILL_NOT_FOUND
+        return _outcome_of_recorded(recorded, bill_id, deposit)
+
+    return BILL_CREATED if created else DEPOSITED
+
+
+async def apply_deposits(
+    database: Database, deposits: List[dict]
+) -> List[str]:
+    """webhook_db_transaction of many signed deposits in one transaction.
+
+    Return the outcome of every deposit, a transaction id repeated in
+    the batch gets the outcome of its first occurrence.
+    """
+    outcomes: List[Optional[str]] = [None] * len(deposits)
+    first_occurrence = {}
+    for index, deposit in enumerate(deposits):
+        first_occurrence.setdefault(deposit["transaction_id"], index)
+    unique = sorted(first_occurrence.values())
+
+    user_ids = await get_existing_user_ids(
+        database, list({deposits[index]["user_id"] for index in unique})
+    )
+    pending = []
+    for index in unique:
+        if deposits[index]["user_id"] in user_ids:
+            pending.append(index)
+        else:
+            outcomes[index] = USER_NOT_FOUND
+
+    if pending:
+        items = [deposits[index] for index in pending]
+        async with database.transaction():
+            created = await create_missing_bills(
+                database,
+                [item["bill_id"] for item in items],
+                [item["user_id"] for item in items],
+            )
+            applied = await bulk_apply_deposits(database, items)
+            funded = {
+                item["bill_id"]
+                for item in items
+                if item["transaction_id"] in applied
+            }
+            if created - funded:
+                await delete_empty_bills(database, list(created - funded))
+
+        # The first deposit to a created bill is the one that created it
+        deposited_bills = set()
+        skipped = []
+        for index in pending:
+            deposit = deposits[index]
+            if deposit["transaction_id"] not in applied:
+                skipped.append(index)
+                continue
+            if deposit["bill_id"] in created - deposited_bills:
+                outcomes[index] = BILL_CREATED
+            else:
+                outcomes[index] = DEPOSITED
+            deposited_bills.add(deposit["bill_id"])
+
+        if skipped:
+            recorded = await get_recorded_deposits(
+                database,
+                [deposits[index]["transaction_id"] for index in skipped],
+            )
+            for index in skipped:
+                deposit = deposits[index]
+                row = recorded.get(deposit["transaction_id"])
+                outcomes[index] = (
+                    _outcome_of_recorded(
+                        row, deposit["bill_id"], deposit["amount"]
+                    )
+                    if row
+                    else BILL_NOT_FOUND
+                )
+
+    for index, deposit in enumerate(deposits):
+        if outcomes[index] is None:
+            first = deposits[first_occurrence[deposit["transaction_id"]]]
+            same = (first["bill_id"], first["amount"]) == (
+                deposit["bill_id"],
+                deposit["amount"],
+            )
+            outcomes[index] = (
+                outcomes[first_occurrence[deposit["transaction_id"]]]
+                if same
+                else CONFLICT
+            )
+    return outcomes
+
+
+def _seen_deposit_key(transaction_id: int) -> str:
+    return f"webhook_tx_{transaction_id}"
+
+
+async def get_seen_deposit_outcomes(
+    conn: Optional[Redis], deposits: List[dict]
+) -> List[Optional[str]]:
+    """Outcomes of recently applied deposits, without touching postgres"""
+    if conn is None:
+        return [None] * len(deposits)
+    stored = await conn.mget(
+        [_seen_deposit_key(item["transaction_id"]) for item in deposits]
+    )
+    return [
+        _outcome_of_recorded(
+            json.loads(value), deposit["bill_id"], deposit["amount"]
         )
-        await connection.execute(
-            "UPDATE bill SET balance = balance + $1 WHERE id = $2",
-            deposit,
-            bill_id,
+        if value
+        else None
+        for deposit, value in zip(deposits, stored)
+    ]
+
+
+async def remember_deposit_outcomes(
+    conn: Optional[Redis], deposits: List[dict], outcomes: List[str]
+):
+    if conn is None:
+        return
+    pipe = conn.pipeline(transaction=False)
+    for deposit, outcome in zip(deposits, outcomes):
+        if outcome not in (DEPOSITED, BILL_CREATED):
+            continue
+        pipe.set(
+            _seen_deposit_key(deposit["transaction_id"]),
+            json.dumps(
+                {
+                    "bill_id": deposit["bill_id"],
+                    "deposit": deposit["amount"],
+                    "created_bill": outcome == BILL_CREATED,
+                }
+            ),
+            ex=settings.WEBHOOK_SEEN_TTL,
         )
-    await connection.close()
+    await pipe.execute()
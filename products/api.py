@@ -2,18 +2,24 @@ from sanic import Blueprint, Request, json, response
 from sanic_openapi.openapi3 import openapi
 from sanic_validation import validate_json
 
-from payment.utils import get_bill, update_bill_balance
+from compression import cached_encoding, encode_cached, variant_etag
+from payment.utils import purchase_product
 from products.json_responses import (ProductPaymentResponse200,
                                      ProductPaymentResponse400,
                                      ProductPaymentResponse404,
                                      ProductPaymentResponse422,
-                                     ProductsListResponse200)
+                                     ProductSearchResponse200,
+                                     ProductsListResponse200,
+                                     ProductsListResponse400)
 from products.json_validators import (ProductPaymentRequestBody,
                                       product_payment_schema)
-from products.utils import get_all_products, get_product_by_id
+from products.utils import (catalog, etag_matches, get_products_page,
+                            iterate_products, parse_page_args,
+                            parse_search_args, search_products)
+from streaming import requested_stream_format, stream_json
 from users.auth import login_required
 from users.json_responses import UnauthorizedResponse401
-from users.models import User
+from users.utils import Principal
 
 products_blueprint = Blueprint("products", url_prefix="api/")
 
@@ -23,9 +29,45 @@ products_blueprint = Blueprint("products", url_prefix="api/")
     "List of products, in order to purchase a product, you will need its id"
 )
 @openapi.tag("Products")
+@openapi.parameter(
+    "after", int, location="query", description="next value of the last page"
+)
+@openapi.parameter(
+    "limit", int, location="query", description="Products per page"
+)
+@openapi.parameter(
+    "fields",
+    str,
+    location="query",
+    description="Comma separated fields to return, e.g. title,price",
+)
+@openapi.parameter(
+    "all",
+    bool,
+    location="query",
+    description="Return the whole catalog in one unpaginated response",
+)
+@openapi.parameter(
+    "stream",
+    bool,
+    location="query",
+    description=(
+        "Stream every product after the cursor, "
+        "send Accept: application/x-ndjson for NDJSON"
+    ),
+)
+@openapi.parameter(
+    "If-None-Match",
+    str,
+    location="header",
+    description="ETag of the whole catalog, 304 is returned if unchanged",
+)
 @openapi.response(
     200, {"application/json": ProductsListResponse200}, "Successful Response"
 )
+@openapi.response(
+    400, {"application/json": ProductsListResponse400}, "Bad Request Error"
+)
 @openapi.response(
     401, {"application/json": UnauthorizedResponse401}, "Unauthorized Error"
 )
@@ -34,19 +76,94 @@ products_blueprint = Blueprint("products", url_prefix="api/")
 )
 async def products_list(request: Request) -> json:
     database = request.app.config["database"]
-    products = await get_all_products(database)
-    data = []
-    for product in products:
-        data.append(
-            {
-                "id": product.id,
-                "title": product.title,
-                "description": product.description,
-                "price": product.price,
-            }
+    if request.args.get("all") == "true":
+        snapshot = await catalog.get(database)
+        headers = {
+            "ETag": variant_etag(
+                snapshot.etag, cached_encoding(request, snapshot.body)
+            ),
+            "Vary": "Accept-Encoding",
+        }
+        if etag_matches(request, headers["ETag"]):
+            return response.empty(status=304, headers=headers)
+        body, encoding = encode_cached(
+            request, snapshot.body, snapshot.variants
+        )
+        if encoding:
+            headers["Content-Encoding"] = encoding
+        return response.raw(
+            body,
+            status=200,
+            headers=headers,
+            content_type="application/json",
+        )
+
+    try:
+        after, limit, fields = parse_page_args(request.args)
+    except ValueError as error:
+        return response.json({"error": str(error)}, status=400)
+
+    stream_format = requested_stream_format(request)
+    if stream_format:
+        await stream_json(
+            request,
+            "products",
+            iterate_products(database, after, fields),
+            lambda row: {field: row[field] for field in fields},
+            stream_format,
         )
-    result = {"products": data}
-    return response.json(result, status=200)
+        return
+
+    products, next_cursor = await get_products_page(
+        database, after, limit, fields
+    )
+    return response.json(
+        {"products": products, "next": next_cursor}, status=200
+    )
+
+
+@openapi.summary("Search products")
+@openapi.description(
+    "Full-text search over titles and descriptions, most relevant first. "
+    "Every word is matched as a prefix"
+)
+@openapi.tag("Products")
+@openapi.parameter("q", str, location="query", required=True)
+@openapi.parameter("min_price", int, location="query")
+@openapi.parameter("max_price", int, location="query")
+@openapi.parameter(
+    "after", str, location="query", description="next value of the last page"
+)
+@openapi.parameter(
+    "limit", int, location="query", description="Products per page"
+)
+@openapi.parameter(
+    "fields",
+    str,
+    location="query",
+    description="Comma separated fields to return, e.g. title,price",
+)
+@openapi.response(
+    200, {"application/json": ProductSearchResponse200}, "Successful Response"
+)
+@openapi.response(
+    400, {"application/json": ProductsListResponse400}, "Bad Request Error"
+)
+@products_blueprint.route(
+    "/products/search", name="products-search", methods=("GET",)
+)
+async def products_search(request: Request) -> json:
+    try:
+        search = parse_search_args(request.args)
+    except ValueError as error:
+        return response.json({"error": str(error)}, status=400)
+
+    products, next_cursor = await search_products(
+        request.app.config["database"], search
+    )
+    return response.json(
+        {"products": products, "next": next_cursor}, status=200
+    )
 
 
 @openapi.summary("Single product")
@@ -88,25 +205,23 @@ async def products_list(request: Request) -> json:
 )
 @login_required(insert_user=True)
 @validate_json(product_payment_schema)
-async def product_payment(request: Request, user: User) -> json:
+async def product_payment(request: Request, user: Principal) -> json:
     product_id = request.json.get("product_id")
     bill_id = request.json.get("bill_id")
     database = request.app.config["database"]
-    product = await get_product_by_id(database, product_id)
-    bill = await get_bill(database, bill_id, user.id)
-    if not bill:
+    purchase = await purchase_product(
+        database, product_id, bill_id, user.id
+    )
+    if not purchase["bill_exists"]:
         return response.json(
             {"error": "The bill id entered incorrectly"}, status=400
         )
-    if not product:
+    if purchase["price"] is None:
         return response.json(
             {"error": "The product was not found"}, status=404
         )
 
-    if bill.balance - product.price >= 0:
-
-        new_balance = bill.balance - product.price
-        await update_bill_balance(database, bill_id, new_balance)
+    if purchase["balance"] is not None:
         return response.json(
             {"message": "The product was successfully purchased"},
             status=200,
@@ -1,6 +1,17 @@
 # Products List
 class ProductsListResponse200:
-    worked = True
+    products = "data list"
+    next = 51
+
+
+class ProductsListResponse400:
+    error = "limit must be between 1 and 500"
+
+
+# Products Search
+class ProductSearchResponse200:
+    products = "data list"
+    next = "0.0607927:51"
 
 
 # Product Payment
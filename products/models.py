@@ -1,4 +1,5 @@
 import sqlalchemy as sa
+from sqlalchemy.dialects.postgresql import TSVECTOR
 
 from main import Base
 
@@ -10,6 +11,22 @@ class Product(Base):
     title = sa.Column(sa.types.String(64), nullable=False)
     description = sa.Column(sa.types.Text, nullable=False)
     price = sa.Column(sa.types.INTEGER, nullable=False)
+    search_vector = sa.Column(
+        TSVECTOR,
+        sa.Computed(
+            "setweight(to_tsvector('simple', title), 'A') || "
+            "setweight(to_tsvector('simple', description), 'B')",
+            persisted=True,
+        ),
+    )
+
+    __table_args__ = (
+        sa.Index(
+            "ix_product_search_vector",
+            "search_vector",
+            postgresql_using="gin",
+        ),
+    )
 
     def to_dict(self):
         return {
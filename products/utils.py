@@ -1,24 +1,297 @@
+import asyncio
+import hashlib
+import re
+import time
+from typing import (AsyncIterator, Dict, List, Mapping, NamedTuple, Optional,
+                    Tuple)
+
+import sqlalchemy as sa
 from databases import Database
+from redis.asyncio import Redis
+from sanic.response import json_dumps
 
+import settings
+from cache import on_invalidation, publish_invalidation
+from metrics import register_metric
 from products.models import product
+from validation import INT32_MAX
+
+PRODUCT_FIELDS = ("id", "title", "description", "price")
+
+
+class CatalogSnapshot(NamedTuple):
+    body: bytes
+    etag: str
+    count: int
+    # encoding -> compressed body, filled on first request of the encoding
+    variants: Dict[str, bytes]
+
+
+class Catalog:
+    """Pre-serialized product list shared by the requests of a worker.
+
+    It is rebuilt after an invalidation or, in case the invalidation
+    message was lost, after CATALOG_SNAPSHOT_TTL seconds.
+    """
+
+    def __init__(self, ttl: float):
+        self.ttl = ttl
+        self.snapshot: Optional[CatalogSnapshot] = None
+        self.version = 0
+        self.builds = 0
+        self._expires_at = 0.0
+        self._lock = asyncio.Lock()
+
+    def _fresh(self) -> Optional[CatalogSnapshot]:
+        if time.monotonic() >= self._expires_at:
+            return None
+        return self.snapshot
+
+    async def get(self, database: Database) -> CatalogSnapshot:
+        snapshot = self._fresh()
+        if snapshot is not None:
+            return snapshot
+
+        async with self._lock:
+            if self._fresh() is None:
+                version = self.version
+                snapshot = await build_catalog_snapshot(database)
+                self.builds += 1
+                # Don't keep a snapshot that was invalidated while building
+                if version != self.version:
+                    return snapshot
+                self.snapshot = snapshot
+                self._expires_at = time.monotonic() + self.ttl
+            return self.snapshot
+
+    def invalidate(self):
+        self.version += 1
+        self.snapshot = None
+
+    def stats(self) -> dict:
+        snapshot = self._fresh()
+        return {
+            "cached": snapshot is not None,
+            "products": snapshot.count if snapshot else 0,
+            "builds": self.builds,
+        }
+
+
+catalog = Catalog(settings.CATALOG_SNAPSHOT_TTL)
+register_metric("catalog", catalog.stats)
+
+
+@on_invalidation(settings.CATALOG_INVALIDATION_CHANNEL)
+def _invalidate_catalog(message: dict):
+    catalog.invalidate()
+
+
+async def build_catalog_snapshot(database: Database) -> CatalogSnapshot:
+    products = [
+        {
+            "id": row["id"],
+            "title": row["title"],
+            "description": row["description"],
+            "price": row["price"],
+        }
+        for row in await get_all_products(database)
+    ]
+    body = json_dumps({"products": products}).encode("utf-8")
+    etag = '"{}"'.format(hashlib.sha256(body).hexdigest()[:32])
+    return CatalogSnapshot(body, etag, len(products), {})
+
+
+async def invalidate_catalog(conn: Redis):
+    """Drop the catalog snapshot in every worker"""
+    await publish_invalidation(
+        conn, settings.CATALOG_INVALIDATION_CHANNEL, {}
+    )
+
+
+def etag_matches(request, etag: str) -> bool:
+    if_none_match = request.headers.get("If-None-Match")
+    if not if_none_match:
+        return False
+    candidates = {
+        candidate.strip().removeprefix("W/")
+        for candidate in if_none_match.split(",")
+    }
+    return "*" in candidates or etag in candidates
 
 
 async def get_all_products(database: Database):
-    query = product.select()
+    query = sa.select(*(product.c[field] for field in PRODUCT_FIELDS))
     return await database.fetch_all(query=query)
 
 
-async def get_product_by_id(database: Database, product_id: int):
-    query = "SELECT price FROM product WHERE id = :product_id"
-    return await database.fetch_one(
-        query=query, values={"product_id": product_id}
+def _parse_limit(args) -> int:
+    try:
+        limit = int(args.get("limit", settings.PRODUCTS_PAGE_SIZE))
+    except ValueError:
+        raise ValueError("limit must be an integer")
+    if not 0 < limit <= settings.PRODUCTS_MAX_PAGE_SIZE:
+        raise ValueError(
+            f"limit must be between 1 and {settings.PRODUCTS_MAX_PAGE_SIZE}"
+        )
+    return limit
+
+
+def _parse_fields(args) -> Tuple[str, ...]:
+    if not args.get("fields"):
+        return PRODUCT_FIELDS
+
+    requested = set(args.get("fields").split(","))
+    unknown = requested.difference(PRODUCT_FIELDS)
+    if unknown:
+        raise ValueError(f"Unknown fields: {', '.join(sorted(unknown))}")
+    # id is always returned, it is the pagination cursor
+    return tuple(
+        field
+        for field in PRODUCT_FIELDS
+        if field == "id" or field in requested
     )
 
 
+def parse_page_args(args) -> Tuple[int, int, Tuple[str, ...]]:
+    """Return after, limit and fields of ?after=&limit=&fields= arguments"""
+    try:
+        after = int(args.get("after", 0))
+    except ValueError:
+        raise ValueError("after must be an integer")
+    if not 0 <= after <= INT32_MAX:
+        raise ValueError(f"after must be between 0 and {INT32_MAX}")
+    return after, _parse_limit(args), _parse_fields(args)
+
+
+class SearchArgs(NamedTuple):
+    tsquery: str
+    min_price: Optional[int]
+    max_price: Optional[int]
+    after: Optional[Tuple[float, int]]
+    limit: int
+    fields: Tuple[str, ...]
+
+
+def parse_search_args(args) -> SearchArgs:
+    """Parse ?q=&min_price=&max_price=&after=&limit=&fields= arguments"""
+    # Every word is matched as a prefix, e.g. "lap bag" -> "lap:* & bag:*"
+    words = re.findall(r"\w+", args.get("q", ""))
+    if not words:
+        raise ValueError("q must contain at least one word")
+    tsquery = " & ".join(f"{word}:*" for word in words)
+
+    try:
+        min_price = args.get("min_price")
+        min_price = int(min_price) if min_price is not None else None
+        max_price = args.get("max_price")
+        max_price = int(max_price) if max_price is not None else None
+    except ValueError:
+        raise ValueError("min_price and max_price must be integers")
+    for price in (min_price, max_price):
+        if price is not None and not 0 <= price <= INT32_MAX:
+            raise ValueError(
+                f"min_price and max_price must be between 0 and {INT32_MAX}"
+            )
+
+    after = None
+    if args.get("after"):
+        try:
+            rank, product_id = args.get("after").split(":")
+            after = (float(rank), int(product_id))
+            if not 0 <= after[1] <= INT32_MAX:
+                raise ValueError
+        except ValueError:
+            raise ValueError("after must be the next value of the last page")
+
+    return SearchArgs(
+        tsquery,
+        min_price,
+        max_price,
+        after,
+        _parse_limit(args),
+        _parse_fields(args),
+    )
+
+
+async def search_products(
+    database: Database, search: SearchArgs
+) -> Tuple[List[dict], Optional[str]]:
+    """Return products ranked by relevance and the cursor of the next page"""
+    filters = ["search_vector @@ query"]
+    values = {"tsquery": search.tsquery, "limit": search.limit + 1}
+    if search.min_price is not None:
+        filters.append("price >= :min_price")
+        values["min_price"] = search.min_price
+    if search.max_price is not None:
+        filters.append("price <= :max_price")
+        values["max_price"] = search.max_price
+
+    cursor_filter = ""
+    if search.after:
+        cursor_filter = """
+               WHERE rank < CAST(:rank AS real)
+                  OR (rank = CAST(:rank AS real) AND id > :after_id)
+        """
+        values["rank"], values["after_id"] = search.after
+
+    columns = ", ".join(search.fields)
+    conditions = " AND ".join(filters)
+    query = f"""
+               SELECT * FROM (
+                   SELECT {columns}, ts_rank(search_vector, query) AS rank
+                   FROM product, to_tsquery('simple', :tsquery) AS query
+                   WHERE {conditions}
+               ) AS matches
+               {cursor_filter}
+               ORDER BY rank DESC, id
+               LIMIT :limit
+            """
+    rows = await database.fetch_all(query=query, values=values)
+    products = [
+        {field: row[field] for field in search.fields}
+        for row in rows[: search.limit]
+    ]
+    next_cursor = None
+    if len(rows) > search.limit:
+        last = rows[search.limit - 1]
+        next_cursor = f"{last['rank']}:{last['id']}"
+    return products, next_cursor
+
+
+async def get_products_page(
+    database: Database, after: int, limit: int, fields: Tuple[str, ...]
+) -> Tuple[List[dict], Optional[int]]:
+    """Return products with id > after and the cursor of the next page"""
+    query = (
+        sa.select(*(product.c[field] for field in fields))
+        .where(product.c.id > after)
+        .order_by(product.c.id)
+        .limit(limit + 1)
+    )
+    rows = await database.fetch_all(query=query)
+    products = [
+        {field: row[field] for field in fields} for row in rows[:limit]
+    ]
+    next_cursor = products[-1]["id"] if len(rows) > limit else None
+    return products, next_cursor
+
+
+def iterate_products(
+    database: Database, after: int, fields: Tuple[str, ...]
+) -> AsyncIterator[Mapping]:
+    """Read products with id > after through a server-side cursor"""
+    query = (
+        sa.select(*(product.c[field] for field in fields))
+        .where(product.c.id > after)
+        .order_by(product.c.id)
+    )
+    return database.iterate(query=query)
+
+
 async def create_product(
     database: Database, title: str, description: str, price: int
 ):
-    return await database.execute(
+    result = await database.execute(
         query=product.insert(),
         values={
             "title": title,
@@ -26,6 +299,8 @@ async def create_product(
             "price": price,
         },
     )
+    catalog.invalidate()
+    return result
 
 
 async def update_product(
@@ -35,7 +310,7 @@ async def update_product(
     description: str,
     price: int,
 ):
-    return await database.execute(
+    result = await database.execute(
         query=product.update().where(product.c.id == product_id),
         values={
             "title": title,
@@ -43,9 +318,82 @@ async def update_product(
             "price": price,
         },
     )
+    catalog.invalidate()
+    return result
 
 
 async def delete_product(database: Database, product_id: int):
-    return await database.execute(
+    result = await database.execute(
         query=product.delete().where(product.c.id == product_id)
     )
+    catalog.invalidate()
+    return result
+
+
+# Bulk operations, one statement per batch
+async def bulk_create_products(
+    database: Database, products: List[dict]
+) -> List[int]:
+    """Insert the products, return their ids in the same order"""
+    query = """
+               INSERT INTO product(title, description, price)
+               SELECT title, description, price
+               FROM unnest(
+                   CAST(:titles AS varchar[]),
+                   CAST(:descriptions AS text[]),
+                   CAST(:prices AS integer[])
+               ) WITH ORDINALITY AS item(title, description, price, position)
+               ORDER BY position
+               RETURNING id
+            """
+    rows = await database.fetch_all(
+        query=query,
+        values={
+            "titles": [item["title"] for item in products],
+            "descriptions": [item["description"] for item in products],
+            "prices": [item["price"] for item in products],
+        },
+    )
+    catalog.invalidate()
+    return [row["id"] for row in rows]
+
+
+async def bulk_update_products(
+    database: Database, products: List[dict]
+) -> List[int]:
+    """Update the products, return the ids that were found"""
+    query = """
+               UPDATE product
+               SET title = item.title,
+                   description = item.description,
+                   price = item.price
+               FROM unnest(
+                   CAST(:ids AS integer[]),
+                   CAST(:titles AS varchar[]),
+                   CAST(:descriptions AS text[]),
+                   CAST(:prices AS integer[])
+               ) AS item(id, title, description, price)
+               WHERE product.id = item.id
+               RETURNING product.id
+            """
+    rows = await database.fetch_all(
+        query=query,
+        values={
+            "ids": [item["id"] for item in products],
+            "titles": [item["title"] for item in products],
+            "descriptions": [item["description"] for item in products],
+            "prices": [item["price"] for item in products],
+        },
+    )
+    catalog.invalidate()
+    return [row["id"] for row in rows]
+
+
+async def bulk_delete_products(
+    database: Database, product_ids: List[int]
+) -> List[int]:
+    """Delete the products, return the ids that were found"""
+    query = "DELETE FROM product WHERE id = ANY(CAST(:ids AS integer[])) RETURNING id"
+    rows = await database.fetch_all(query=query, values={"ids": product_ids})
+    catalog.invalidate()
+    return [row["id"] for row in rows]
@@ -0,0 +1,134 @@
+import uuid
+from functools import wraps
+from typing import Callable
+
+from redis.asyncio import Redis
+from sanic_session import InMemorySessionInterface
+from sanic_session.base import (BaseSessionInterface, SessionDict,
+                                get_request_container)
+
+import settings
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+    import json
+
+
+def dumps(data: dict) -> bytes:
+    if msgpack is not None:
+        return msgpack.packb(data, use_bin_type=True)
+    return json.dumps(data).encode("utf-8")
+
+
+def loads(value: bytes) -> dict:
+    if msgpack is not None:
+        return msgpack.unpackb(value, raw=False)
+    return json.loads(value)
+
+
+class RedisSessionInterface(BaseSessionInterface):
+    """Sessions shared by every worker and node through the redis pool.
+
+    Requests without a session cookie don't touch redis, and sessions
+    that weren't modified are neither written back nor re-sent as cookies.
+    """
+
+    def __init__(
+        self,
+        redis_getter: Callable[[], Redis],
+        domain: str = None,
+        expiry: int = 2592000,
+        httponly: bool = True,
+        cookie_name: str = "session",
+        prefix: str = "session:",
+        sessioncookie: bool = False,
+        samesite: str = None,
+        session_name="session",
+        secure: bool = False,
+    ):
+        super().__init__(
+            expiry=expiry,
+            prefix=prefix,
+            cookie_name=cookie_name,
+            domain=domain,
+            httponly=httponly,
+            sessioncookie=sessioncookie,
+            samesite=samesite,
+            session_name=session_name,
+            secure=secure,
+        )
+        self.redis_getter = redis_getter
+
+    async def _get_value(self, prefix: str, sid: str):
+        return await self.redis_getter().get(prefix + sid)
+
+    async def _delete_key(self, key: str):
+        await self.redis_getter().delete(key)
+
+    async def _set_value(self, key: str, data: bytes):
+        await self.redis_getter().set(key, data, ex=self.expiry)
+
+    async def open(self, request) -> SessionDict:
+        sid = request.cookies.get(self.cookie_name)
+
+        session_dict = None
+        if sid:
+            val = await self._get_value(self.prefix, sid)
+            if val is not None:
+                session_dict = SessionDict(loads(val), sid=sid)
+
+        if session_dict is None:
+            session_dict = SessionDict(sid=sid or uuid.uuid4().hex)
+
+        req = get_request_container(request)
+        req[self.session_name] = session_dict
+        return session_dict
+
+    async def save(self, request, response) -> None:
+        req = get_request_container(request)
+        session_dict = req.get(self.session_name)
+        if session_dict is None or not session_dict.modified:
+            return
+
+        key = self.prefix + session_dict.sid
+        if not session_dict:
+            await self._delete_key(key)
+            self._delete_cookie(request, response)
+            return
+
+        await self._set_value(key, dumps(dict(session_dict)))
+        self._set_cookie_props(request, response)
+
+
+def get_session_interface(app) -> BaseSessionInterface:
+    """Return the session interface selected by SESSION_BACKEND"""
+    if settings.SESSION_BACKEND == "redis" and app.config["REDIS_USE"]:
+        return RedisSessionInterface(
+            lambda: app.config["redis"],
+            expiry=settings.SESSION_EXPIRY,
+            prefix=settings.SESSION_PREFIX,
+        )
+    return InMemorySessionInterface(expiry=settings.SESSION_EXPIRY)
+
+
+def session_required():
+    """Open the session before the handler and save it afterwards.
+
+    Sessions are opt-in per route, so the rest of the API doesn't pay
+    for loading them or get session cookies.
+    """
+
+    def decorator(func):
+        @wraps(func)
+        async def decorated_function(request, *args, **kwargs):
+            interface = request.app.ctx.session_interface
+            await interface.open(request)
+            response = await func(request, *args, **kwargs)
+            await interface.save(request, response)
+            return response
+
+        return decorated_function
+
+    return decorator
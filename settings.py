@@ -39,10 +39,157 @@ LOGGER_SETTINGS = {
 JWT_SECRET = os.environ.get("JWT_SECRET", "d3f73888-f725-41f2-ae33-df5bbaf99cbc")
 SECRET_KEY = os.environ.get("SECRET_KEY", "8e06922f-b52e-4203-ba61-66d54594e49e")
 private_key = os.environ.get("private_key", "Qsd@3fd")
+# Seconds the outcome of a webhook deposit is kept in redis for retries
+WEBHOOK_SEEN_TTL = int(os.environ.get("WEBHOOK_SEEN_TTL", "86400"))
+# Default and maximum ?limit= of the transaction history of a bill
+TRANSACTIONS_PAGE_SIZE = int(os.environ.get("TRANSACTIONS_PAGE_SIZE", "50"))
+TRANSACTIONS_MAX_PAGE_SIZE = int(
+    os.environ.get("TRANSACTIONS_MAX_PAGE_SIZE", "500")
+)
+# transaction is partitioned by month, partitions for the current and
+# TRANSACTION_PARTITIONS_AHEAD next months are created every
+# TRANSACTION_PARTITION_INTERVAL seconds, 0 disables it
+TRANSACTION_PARTITIONS_AHEAD = int(
+    os.environ.get("TRANSACTION_PARTITIONS_AHEAD", "3")
+)
+TRANSACTION_PARTITION_INTERVAL = float(
+    os.environ.get("TRANSACTION_PARTITION_INTERVAL", "86400")
+)
+# Maximum number of deposits in one batch webhook request
+WEBHOOK_BATCH_MAX_SIZE = int(os.environ.get("WEBHOOK_BATCH_MAX_SIZE", "10000"))
+# "sync" applies deposits in the webhook request, "stream" appends them to
+# DEPOSIT_STREAM and answers 202, consumers of DEPOSIT_CONSUMER_GROUP apply
+# them in batches. DEPOSIT_CONSUMER_IN_APP runs a consumer in every worker,
+# otherwise run "python commands.py consume_deposits"
+WEBHOOK_INGESTION = os.environ.get("WEBHOOK_INGESTION", "sync")
+DEPOSIT_STREAM = os.environ.get("DEPOSIT_STREAM", "deposits")
+DEPOSIT_CONSUMER_GROUP = os.environ.get(
+    "DEPOSIT_CONSUMER_GROUP", "deposit_appliers"
+)
+DEPOSIT_CONSUMER_IN_APP = (
+    os.environ.get("DEPOSIT_CONSUMER_IN_APP", "1") == "1"
+)
+DEPOSIT_BATCH_SIZE = int(os.environ.get("DEPOSIT_BATCH_SIZE", "500"))
+DEPOSIT_BLOCK_MS = int(os.environ.get("DEPOSIT_BLOCK_MS", "1000"))
+# Entries unacked for this long are reclaimed from their consumer, after
+# DEPOSIT_MAX_DELIVERIES deliveries they go to DEPOSIT_DEAD_LETTER_STREAM
+DEPOSIT_CLAIM_IDLE_MS = int(os.environ.get("DEPOSIT_CLAIM_IDLE_MS", "60000"))
+DEPOSIT_MAX_DELIVERIES = int(os.environ.get("DEPOSIT_MAX_DELIVERIES", "5"))
+DEPOSIT_DEAD_LETTER_STREAM = os.environ.get(
+    "DEPOSIT_DEAD_LETTER_STREAM", "deposits_dead"
+)
+# The stream is trimmed to about this many entries, keep it well above
+# the backlog consumers may fall behind, unapplied entries are trimmed too
+DEPOSIT_STREAM_MAXLEN = int(
+    os.environ.get("DEPOSIT_STREAM_MAXLEN", "1000000")
+)
+
+# Key for the HMAC digests of session tokens stored in redis
+TOKEN_HMAC_KEY = os.environ.get("TOKEN_HMAC_KEY", SECRET_KEY)
+
+# "redis" keeps a token per user in redis, "stateless" issues short lived
+# signed access tokens checked in-process against a denylist of revoked ones
+TOKEN_MODE = os.environ.get("TOKEN_MODE", "redis")
+ACCESS_TOKEN_LIFETIME = int(os.environ.get("ACCESS_TOKEN_LIFETIME", "900"))
+REVOKED_TOKENS_KEY = os.environ.get("REVOKED_TOKENS_KEY", "revoked_tokens")
+REVOKED_TOKENS_CHANNEL = os.environ.get(
+    "REVOKED_TOKENS_CHANNEL", "revoked_tokens"
+)
+REVOCATION_SYNC_INTERVAL = float(
+    os.environ.get("REVOCATION_SYNC_INTERVAL", "60")
+)
+
+# Per worker cache of verified tokens, TTL is in seconds
+TOKEN_CACHE_SIZE = int(os.environ.get("TOKEN_CACHE_SIZE", "10000"))
+TOKEN_CACHE_TTL = float(os.environ.get("TOKEN_CACHE_TTL", "60"))
+TOKEN_INVALIDATION_CHANNEL = os.environ.get(
+    "TOKEN_INVALIDATION_CHANNEL", "token_invalidation"
+)
+
+# Activation links are kept in "sql" (user_verification table) or "redis",
+# they expire after ACTIVATION_TOKEN_TTL seconds. Stale rows of the table
+# are deleted every VERIFICATION_CLEANUP_INTERVAL seconds, 0 disables it
+ACTIVATION_TOKEN_STORAGE = os.environ.get("ACTIVATION_TOKEN_STORAGE", "sql")
+ACTIVATION_TOKEN_TTL = int(os.environ.get("ACTIVATION_TOKEN_TTL", "86400"))
+VERIFICATION_CLEANUP_INTERVAL = float(
+    os.environ.get("VERIFICATION_CLEANUP_INTERVAL", "3600")
+)
+
+# Per worker Bloom filter of taken usernames, registrations are sent to
+# every worker on USERNAME_FILTER_CHANNEL and the filter is rebuilt from
+# the users table every USERNAME_FILTER_REBUILD_INTERVAL seconds
+USERNAME_FILTER_CAPACITY = int(
+    os.environ.get("USERNAME_FILTER_CAPACITY", "100000")
+)
+USERNAME_FILTER_ERROR_RATE = float(
+    os.environ.get("USERNAME_FILTER_ERROR_RATE", "0.01")
+)
+USERNAME_FILTER_REBUILD_INTERVAL = float(
+    os.environ.get("USERNAME_FILTER_REBUILD_INTERVAL", "600")
+)
+USERNAME_FILTER_CHANNEL = os.environ.get(
+    "USERNAME_FILTER_CHANNEL", "username_filter"
+)
+
+# Default and maximum ?limit= of the paginated product listings
+PRODUCTS_PAGE_SIZE = int(os.environ.get("PRODUCTS_PAGE_SIZE", "50"))
+PRODUCTS_MAX_PAGE_SIZE = int(os.environ.get("PRODUCTS_MAX_PAGE_SIZE", "500"))
+# Maximum number of products in one admin bulk request
+PRODUCTS_BULK_MAX_SIZE = int(os.environ.get("PRODUCTS_BULK_MAX_SIZE", "5000"))
+CATALOG_INVALIDATION_CHANNEL = os.environ.get(
+    "CATALOG_INVALIDATION_CHANNEL", "catalog_invalidation"
+)
+# Seconds a worker serves its catalog snapshot without an invalidation
+CATALOG_SNAPSHOT_TTL = float(os.environ.get("CATALOG_SNAPSHOT_TTL", "60"))
+
+# Per worker cache of id, username, is_active, is_admin of the users
+PRINCIPAL_CACHE_SIZE = int(os.environ.get("PRINCIPAL_CACHE_SIZE", "10000"))
+PRINCIPAL_CACHE_TTL = float(os.environ.get("PRINCIPAL_CACHE_TTL", "5"))
+USER_INVALIDATION_CHANNEL = os.environ.get(
+    "USER_INVALIDATION_CHANNEL", "user_invalidation"
+)
+
+# gzip, and brotli when installed, for bodies of at least
+# COMPRESSION_MIN_SIZE bytes
+COMPRESSION_ENABLED = os.environ.get("COMPRESSION_ENABLED", "1") == "1"
+COMPRESSION_MIN_SIZE = int(os.environ.get("COMPRESSION_MIN_SIZE", "1024"))
+COMPRESSION_GZIP_LEVEL = int(os.environ.get("COMPRESSION_GZIP_LEVEL", "6"))
+COMPRESSION_BROTLI_LEVEL = int(
+    os.environ.get("COMPRESSION_BROTLI_LEVEL", "5")
+)
 
 
 REDIS_HOST = os.environ.get("REDIS_HOST", "127.0.0.1")
 REDIS_PORT = os.environ.get("REDIS_PORT", "6379")
+REDIS_MAX_CONNECTIONS = int(os.environ.get("REDIS_MAX_CONNECTIONS", "50"))
+# Timeouts are in seconds
+REDIS_SOCKET_TIMEOUT = float(os.environ.get("REDIS_SOCKET_TIMEOUT", "5"))
+REDIS_SOCKET_CONNECT_TIMEOUT = float(
+    os.environ.get("REDIS_SOCKET_CONNECT_TIMEOUT", "5")
+)
+
+# "memory" keeps sessions in the worker, "redis" shares them between
+# workers and nodes. SESSION_EXPIRY is in seconds
+SESSION_BACKEND = os.environ.get("SESSION_BACKEND", "redis")
+SESSION_EXPIRY = int(os.environ.get("SESSION_EXPIRY", "86400"))
+SESSION_PREFIX = os.environ.get("SESSION_PREFIX", "session:")
+
+# Password hashing runs in a separate pool so PBKDF2 does not block the loop
+# PASSWORD_HASH_EXECUTOR is "process" or "thread"
+PASSWORD_HASH_EXECUTOR = os.environ.get("PASSWORD_HASH_EXECUTOR", "process")
+PASSWORD_HASH_WORKERS = int(os.environ.get("PASSWORD_HASH_WORKERS", "2"))
+# New hashes use this PBKDF2 cost, older ones are rehashed on login.
+# "python commands.py calibrate_hash" recommends a value for the host
+PASSWORD_HASH_ITERATIONS = int(
+    os.environ.get("PASSWORD_HASH_ITERATIONS", "100000")
+)
+# Login / register hashing admission: running jobs, waiting jobs, after
+# that requests are rejected with 503 and Retry-After (seconds)
+HASH_CONCURRENCY = int(
+    os.environ.get("HASH_CONCURRENCY", PASSWORD_HASH_WORKERS)
+)
+HASH_QUEUE_SIZE = int(os.environ.get("HASH_QUEUE_SIZE", "32"))
+HASH_RETRY_AFTER = int(os.environ.get("HASH_RETRY_AFTER", "1"))
 
 connection = "postgresql://{0}:{1}@{2}/{3}".format(
     os.environ.get("DATABASE_USER", "postgres"),
@@ -0,0 +1,58 @@
+from typing import AsyncIterator, Callable, Mapping, Optional
+
+from sanic.request import Request
+from sanic.response import json_dumps
+
+NDJSON_CONTENT_TYPE = "application/x-ndjson"
+# Serialized items are sent in chunks of about this many bytes
+STREAM_CHUNK_SIZE = 64 * 1024
+
+
+def requested_stream_format(request: Request) -> Optional[str]:
+    """Return "ndjson" or "json" when the client asked for a streamed list.
+
+    NDJSON is selected with "Accept: application/x-ndjson", a streamed
+    JSON document (same shape as the buffered one) with "?stream=true".
+    """
+    if NDJSON_CONTENT_TYPE in request.headers.get("Accept", ""):
+        return "ndjson"
+    if request.args.get("stream") == "true":
+        return "json"
+    return None
+
+
+async def stream_json(
+    request: Request,
+    key: str,
+    rows: AsyncIterator[Mapping],
+    serialize: Callable[[Mapping], dict],
+    stream_format: str,
+) -> None:
+    """Send serialize(row) of every row as it is read from the cursor,
+    so memory use doesn't depend on the size of the result"""
+    if stream_format == "ndjson":
+        response = await request.respond(content_type=NDJSON_CONTENT_TYPE)
+        opening, separator, closing = "", "\n", "\n"
+    else:
+        response = await request.respond(content_type="application/json")
+        opening, separator, closing = f'{{"{key}":[', ",", "]}"
+
+    chunk = [opening]
+    size = len(opening)
+    first = True
+    async for row in rows:
+        item = json_dumps(serialize(row))
+        if not first:
+            chunk.append(separator)
+        chunk.append(item)
+        size += len(item) + 1
+        first = False
+        if size >= STREAM_CHUNK_SIZE:
+            await response.send("".join(chunk))
+            chunk = []
+            size = 0
+
+    if stream_format == "json" or not first:
+        chunk.append(closing)
+    await response.send("".join(chunk))
+    await response.eof()
@@ -8,21 +8,38 @@ from sanic_openapi.openapi3 import openapi
 from sanic_validation import validate_json
 
 import settings
-from users.auth import JWTAuthorization
+from sessions import session_required
+from users.auth import JWTAuthorization, login_required
 from users.json_responses import (ActivateUserResponse200,
                                   ActivateUserResponse403,
-                                  ActivateUserResponse404, LoginResponse200,
-                                  LoginResponse401, RegisterResponse400,
-                                  RegisterStatusCode201)
+                                  ActivateUserResponse404,
+                                  CheckUsernameResponse200,
+                                  CheckUsernameResponse400, LoginResponse200,
+                                  LoginResponse401, RefreshTokenResponse200,
+                                  RegisterResponse400, RegisterStatusCode201,
+                                  ServiceUnavailableResponse503,
+                                  UnauthorizedResponse401)
 from users.json_validators import (LoginRequestBody, RegisterRequestBody,
                                    login_schema, register_schema)
-from users.utils import (activate_user, create_user, create_user_verification,
-                         filter_by_user_verification, get_user_by_username,
-                         verify_hash)
+from users.utils import (HashingOverloaded, activate_user, add_taken_username,
+                         async_generate_hash, async_verify_hash,
+                         consume_activation_token, consume_user_verification,
+                         create_activation_token, create_user,
+                         create_user_with_verification, get_user_by_username,
+                         hash_limiter, invalidate_principal, is_username_taken,
+                         needs_rehash, update_password_hash, username_filter)
 
 users_blueprint = Blueprint("users", url_prefix="api/")
 
 
+def hashing_overloaded_response():
+    return response.json(
+        {"error": "The server is busy, try again later"},
+        status=503,
+        headers={"Retry-After": str(settings.HASH_RETRY_AFTER)},
+    )
+
+
 @openapi.summary("Create a new account")
 @openapi.description(
     "Enter username and password you will be "
@@ -43,16 +60,40 @@ users_blueprint = Blueprint("users", url_prefix="api/")
 @openapi.response(
     400, {"application/json": RegisterResponse400}, "Bad Request Error"
 )
+@openapi.response(
+    503,
+    {"application/json": ServiceUnavailableResponse503},
+    "Service Unavailable Error",
+)
 @users_blueprint.route("/register", name="register", methods=("POST",))
 @validate_json(register_schema)
+@session_required()
 async def register(request: Request) -> json:
     username = request.json.get("username")
     password = request.json.get("password")
+    database = request.app.config["database"]
+    if username_filter.might_be_taken(username) and await is_username_taken(
+        database, username
+    ):
+        return response.json(
+            {"error": "User with this username already exists"},
+            status=400,
+        )
+
     try:
         link = uuid.uuid4()
-        database = request.app.config["database"]
-        user_id = await create_user(database, username, password)
-        await create_user_verification(database, link, user_id)
+        async with hash_limiter:
+            hashed_password = await async_generate_hash(password)
+        if settings.ACTIVATION_TOKEN_STORAGE == "redis":
+            user_id = await create_user(database, username, hashed_password)
+            await create_activation_token(
+                request.app.config["redis"], link, user_id
+            )
+        else:
+            user_id = await create_user_with_verification(
+                database, username, hashed_password, link
+            )
+        await add_taken_username(request.app.config["redis"], username)
         request.ctx.session["user_data"] = (user_id, username)
         url = f"{settings.PROTOCOL}://{settings.HOST}/api/register/activate-user/{link}"
 
@@ -62,10 +103,43 @@ async def register(request: Request) -> json:
         )
 
     except UniqueViolationError:
+        await add_taken_username(request.app.config["redis"], username)
         return response.json(
             {"error": "User with this username already exists"},
             status=400,
         )
+    except HashingOverloaded:
+        return hashing_overloaded_response()
+
+
+@openapi.summary("Check username availability")
+@openapi.description("Check if the username is free before registering")
+@openapi.tag("Authentication")
+@openapi.parameter("username", str, location="query", required=True)
+@openapi.response(
+    200, {"application/json": CheckUsernameResponse200}, "Successful Response"
+)
+@openapi.response(
+    400, {"application/json": CheckUsernameResponse400}, "Bad Request Error"
+)
+@users_blueprint.route(
+    "/register/check-username", name="check-username", methods=("GET",)
+)
+async def check_username(request: Request) -> json:
+    username = request.args.get("username")
+    if not username or len(username) > 64:
+        return response.json(
+            {"error": "username length must be between 1 and 64 characters"},
+            status=400,
+        )
+
+    taken = False
+    if username_filter.might_be_taken(username):
+        database = request.app.config["database"]
+        taken = await is_username_taken(database, username)
+    return response.json(
+        {"username": username, "available": not taken}, status=200
+    )
 
 
 @openapi.summary("Activate an account")
@@ -88,12 +162,22 @@ async def register(request: Request) -> json:
     name="activate-user",
     methods=("GET",),
 )
+@session_required()
 async def activation(request: Request, primary_key: uuid.UUID) -> json:
     try:
         user_id, username = request.ctx.session["user_data"]
         database = request.app.config["database"]
-        if await filter_by_user_verification(database, primary_key, user_id):
+        if settings.ACTIVATION_TOKEN_STORAGE == "redis":
+            verified = await consume_activation_token(
+                request.app.config["redis"], primary_key, user_id
+            )
+        else:
+            verified = await consume_user_verification(
+                database, primary_key, user_id
+            )
+        if verified:
             await activate_user(database, user_id)
+            await invalidate_principal(request.app.config["redis"], user_id)
             token = await JWTAuthorization.user_authorize(
                 request, user_id, username
             )
@@ -128,6 +212,11 @@ async def activation(request: Request, primary_key: uuid.UUID) -> json:
 @openapi.response(
     401, {"application/json": LoginResponse401}, "Unauthorized Error"
 )
+@openapi.response(
+    503,
+    {"application/json": ServiceUnavailableResponse503},
+    "Service Unavailable Error",
+)
 @users_blueprint.route("/login", methods=("POST",))
 @validate_json(login_schema)
 async def login(request: Request) -> json:
@@ -135,7 +224,21 @@ async def login(request: Request) -> json:
     password = request.json.get("password")
     database = request.app.config["database"]
     user = await get_user_by_username(database, username)
-    if user and verify_hash(dict(user)["hashed_password"], password):
+    verified = False
+    if user:
+        try:
+            async with hash_limiter:
+                verified = await async_verify_hash(
+                    dict(user)["hashed_password"], password
+                )
+        except HashingOverloaded:
+            return hashing_overloaded_response()
+
+    if verified:
+        if needs_rehash(dict(user)["hashed_password"]):
+            request.app.add_task(
+                update_password_hash(database, dict(user)["id"], password)
+            )
         token = await JWTAuthorization.user_authorize(
             request, dict(user)["id"], username
         )
@@ -147,3 +250,33 @@ async def login(request: Request) -> json:
             {"error": "The username or password is entered incorrectly"},
             status=401,
         )
+
+
+@openapi.summary("Refresh the token")
+@openapi.description(
+    "Exchange a valid token for a new one, the old token stops working"
+)
+@openapi.tag("Authentication")
+@openapi.parameter(
+    "Authorization",
+    str,
+    location="header",
+    required=True,
+    description="Bearer Token",
+)
+@openapi.response(
+    200, {"application/json": RefreshTokenResponse200}, "Successful Response"
+)
+@openapi.response(
+    401, {"application/json": UnauthorizedResponse401}, "Unauthorized Error"
+)
+@users_blueprint.route(
+    "/token/refresh", name="token-refresh", methods=("POST",)
+)
+@login_required()
+async def refresh_token(request: Request) -> json:
+    token = await JWTAuthorization.refresh(request)
+    return response.json(
+        {"message": "The token was successfully refreshed", "token": token},
+        status=200,
+    )
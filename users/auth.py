@@ -1,18 +1,104 @@
+import asyncio
 import datetime
 import inspect
 import json
+import time
 import uuid
 from functools import wraps
 from typing import Optional
 
 import jwt
-import redis
-from redis import ConnectionPool
+from redis.asyncio import Redis
 from sanic import response
+from sanic.log import logger
 
 import settings
-from users.utils import (generate_hash, get_user_by_id, is_user_active,
-                         is_user_admin, verify_hash)
+from cache import TTLCache, on_invalidation, publish_invalidation
+from metrics import register_metric
+from users.utils import (Principal, async_verify_hash, generate_token_digest,
+                         get_principal, verify_token_digest)
+
+# Authorization header -> (username, user_id) of already verified tokens
+token_cache = TTLCache(settings.TOKEN_CACHE_SIZE, settings.TOKEN_CACHE_TTL)
+register_metric("token_cache", token_cache.stats)
+
+
+@on_invalidation(settings.TOKEN_INVALIDATION_CHANNEL)
+def _invalidate_cached_tokens(message: dict):
+    if "username" in message:
+        token_cache.discard_where(
+            lambda key, value: value[0] == message["username"]
+        )
+    if "user_id" in message:
+        token_cache.discard_where(
+            lambda key, value: value[1] == message["user_id"]
+        )
+
+
+class RevocationList:
+    """jti -> exp of revoked stateless tokens that haven't expired yet"""
+
+    def __init__(self):
+        self._entries = {}
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, jti: str):
+        exp = self._entries.get(jti)
+        return exp is not None and exp > time.time()
+
+    def add(self, jti: str, exp: float):
+        self._entries[jti] = exp
+
+    def replace(self, entries: dict):
+        self._entries = entries
+
+
+revoked_tokens = RevocationList()
+register_metric("revoked_tokens", lambda: {"size": len(revoked_tokens)})
+
+
+@on_invalidation(settings.REVOKED_TOKENS_CHANNEL)
+def _add_revoked_token(message: dict):
+    revoked_tokens.add(message["jti"], message["exp"])
+
+
+async def sync_revoked_tokens(app):
+    """Reload the denylist from redis, pub/sub fills it between syncs.
+
+    When redis is unavailable the current list is kept, so requests
+    with stateless tokens are still served.
+    """
+    conn = app.config["redis"]
+    while True:
+        try:
+            now = time.time()
+            await conn.zremrangebyscore(
+                settings.REVOKED_TOKENS_KEY, "-inf", now
+            )
+            entries = await conn.zrangebyscore(
+                settings.REVOKED_TOKENS_KEY, now, "+inf", withscores=True
+            )
+            revoked_tokens.replace(
+                {jti.decode(): exp for jti, exp in entries}
+            )
+        except Exception:
+            logger.exception("Can't sync revoked tokens from redis")
+        await asyncio.sleep(settings.REVOCATION_SYNC_INTERVAL)
+
+
+async def load_principal(request) -> Optional[Principal]:
+    """Attach the active authorized user to request.ctx.principal"""
+    user_id = await JWTAuthorization.get_id_if_authorized(request)
+    if not user_id:
+        return None
+
+    principal = await get_principal(request.app.config["database"], user_id)
+    if principal and principal.is_active:
+        request.ctx.principal = principal
+        return principal
+    return None
 
 
 def login_required(insert_user=False):
@@ -20,15 +106,13 @@ def login_required(insert_user=False):
         @wraps(func)
         async def decorated_function(request, *args, **kwargs):
 
-            user_id = await JWTAuthorization.get_id_if_authorized(request)
-            database = request.app.config["database"]
+            principal = await load_principal(request)
 
-            if await is_user_active(database, user_id):
+            if principal:
 
                 if insert_user:
 
-                    user = await get_user_by_id(database, user_id=user_id)
-                    res = func(request, user, *args, **kwargs)
+                    res = func(request, principal, *args, **kwargs)
 
                     if inspect.isawaitable(res):
                         return await res
@@ -54,12 +138,10 @@ def admin_rights_required():
         @wraps(func)
         async def decorated_function(request, *args, **kwargs):
 
-            user_id = await JWTAuthorization.get_id_if_authorized(request)
-            database = request.app.config["database"]
+            principal = await load_principal(request)
 
-            if await is_user_active(database, user_id):
-                admin = await is_user_admin(database, user_id=user_id)
-                if admin:
+            if principal:
+                if principal.is_admin:
                     return await func(request, *args, **kwargs)
                 else:
                     return response.json(
@@ -83,18 +165,17 @@ def admin_rights_required():
 
 class JWTAuthorization:
     @staticmethod
-    def _generate_token(
-        redis_pool: ConnectionPool, user_id: int, username: str
+    async def _generate_token(
+        conn: Redis, user_id: int, username: str
     ) -> str:
         """Generate token and store it, return token_key"""
 
-        conn = redis.Redis(connection_pool=redis_pool)
         token_key = str(uuid.uuid4())
         store_data = {
             "user_id": user_id,
-            "token_hash": generate_hash(token_key),
+            "token_digest": generate_token_digest(token_key),
         }
-        conn.set(
+        await conn.set(
             f"tokens_{username}",
             json.dumps(store_data),
             ex=datetime.timedelta(hours=24),
@@ -102,48 +183,136 @@ class JWTAuthorization:
         return token_key
 
     @staticmethod
-    def _remove_token(redis_pool: ConnectionPool, username: str):
+    async def _remove_token(conn: Redis, username: str):
         """Remove token from storage"""
 
-        conn = redis.Redis(connection_pool=redis_pool)
-        conn.delete(username)
+        await conn.delete(f"tokens_{username}")
+
+    @staticmethod
+    def _encode_access_token(user_id: int, username: str) -> str:
+        """Return a signed token that is verified without redis"""
+        issued_at = datetime.datetime.utcnow()
+        payload = {
+            "username": username,
+            "user_id": user_id,
+            "jti": uuid.uuid4().hex,
+            "iat": issued_at,
+            "exp": issued_at
+            + datetime.timedelta(seconds=settings.ACCESS_TOKEN_LIFETIME),
+        }
+        encoded_jwt = jwt.encode(
+            payload, settings.JWT_SECRET, algorithm="HS256"
+        )
+        return encoded_jwt.decode("UTF-8")
+
+    @staticmethod
+    async def _revoke_access_token(conn: Redis, jwt_data: dict):
+        """Add the token to the denylist until it expires"""
+
+        await conn.zadd(
+            settings.REVOKED_TOKENS_KEY, {jwt_data["jti"]: jwt_data["exp"]}
+        )
+        await publish_invalidation(
+            conn,
+            settings.REVOKED_TOKENS_CHANNEL,
+            {"jti": jwt_data["jti"], "exp": jwt_data["exp"]},
+        )
 
     @staticmethod
     def _get_jwt_data_from_request(request) -> Optional[dict]:
         """Return token from request"""
         authorization = request.headers.get("Authorization")
         if authorization:
-            return jwt.decode(
-                authorization[7:], settings.JWT_SECRET, algorithms=["HS256"]
-            )
+            try:
+                return jwt.decode(
+                    authorization[7:],
+                    settings.JWT_SECRET,
+                    algorithms=["HS256"],
+                )
+            except jwt.InvalidTokenError:
+                return None
 
     @classmethod
     async def get_id_if_authorized(cls, request) -> Optional[int]:
         """Check if the user is authorized"""
+        authorization = request.headers.get("Authorization")
+        cached = token_cache.get(authorization)
+        if cached:
+            return cached[1]
+
         jwt_data = cls._get_jwt_data_from_request(request)
-        redis_pool = request.app.config["redis_pool"]
+        conn = request.app.config["redis"]
 
         if not jwt_data:
             return False
 
-        conn = redis.Redis(connection_pool=redis_pool)
+        if "jti" in jwt_data:
+            # Stateless access token, jwt.decode has already checked exp
+            if jwt_data["jti"] in revoked_tokens:
+                return False
+            return int(jwt_data["user_id"])
+
         username = jwt_data["username"]
-        store_data = json.loads(conn.get(f"tokens_{username}"))
-        if not store_data:
+        # A logout applied while verifying must not be undone by caching
+        generation = token_cache.generation
+        pipe = conn.pipeline(transaction=False)
+        pipe.get(f"tokens_{username}")
+        pipe.ttl(f"tokens_{username}")
+        stored, expires_in = await pipe.execute()
+        if not stored:
             return False
+        store_data = json.loads(stored)
 
-        token_hash = store_data["token_hash"]
+        if "token_digest" in store_data:
+            verified = verify_token_digest(
+                store_data["token_digest"], jwt_data["token"]
+            )
+        else:
+            # Tokens issued before the switch to HMAC digests keep
+            # the PBKDF2 hash until they expire
+            verified = await async_verify_hash(
+                store_data["token_hash"], jwt_data["token"]
+            )
 
-        if verify_hash(token_hash, jwt_data["token"]):
-            return int(store_data["user_id"])
+        if verified:
+            user_id = int(store_data["user_id"])
+            # A negative ttl means the key has no expiry
+            token_cache.set(
+                authorization,
+                (username, user_id),
+                ttl=expires_in if expires_in >= 0 else None,
+                generation=generation,
+            )
+            return user_id
 
         return False
 
+    @staticmethod
+    async def revoke_cached_tokens(
+        request, username: str = None, user_id: int = None
+    ):
+        """Drop verified tokens of the user from the cache of every worker"""
+        message = {}
+        if username is not None:
+            message["username"] = username
+        if user_id is not None:
+            message["user_id"] = user_id
+        await publish_invalidation(
+            request.app.config["redis"],
+            settings.TOKEN_INVALIDATION_CHANNEL,
+            message,
+        )
+
     @classmethod
     async def user_authorize(cls, request, user_id: int, username: str) -> str:
         """Authorize user"""
-        redis_pool = request.app.config["redis_pool"]
-        token = cls._generate_token(redis_pool, user_id, username)
+        if settings.TOKEN_MODE == "stateless":
+            return cls._encode_access_token(user_id, username)
+
+        conn = request.app.config["redis"]
+        token = await cls._generate_token(conn, user_id, username)
+        # The previous token of this user is overwritten in redis
+        await cls.revoke_cached_tokens(request, username=username)
 
         payload = {"username": username, "token": token}
         encoded_jwt = jwt.encode(
@@ -155,8 +324,28 @@ class JWTAuthorization:
     @classmethod
     async def user_un_authorize(cls, request):
         """Un authorize user"""
-        redis_pool = request.app.config["redis_pool"]
+        conn = request.app.config["redis"]
+        jwt_data = cls._get_jwt_data_from_request(request)
+        assert jwt_data
+
+        if "jti" in jwt_data:
+            await cls._revoke_access_token(conn, jwt_data)
+            return
+
+        await cls._remove_token(conn, jwt_data["username"])
+        await cls.revoke_cached_tokens(request, username=jwt_data["username"])
+
+    @classmethod
+    async def refresh(cls, request) -> str:
+        """Reissue the token of an authorized request, revoke the old one"""
         jwt_data = cls._get_jwt_data_from_request(request)
         assert jwt_data
 
-        cls._remove_token(redis_pool, jwt_data["username"])
+        if "jti" in jwt_data:
+            await cls._revoke_access_token(
+                request.app.config["redis"], jwt_data
+            )
+        principal = request.ctx.principal
+        return await cls.user_authorize(
+            request, principal.id, principal.username
+        )
@@ -10,6 +10,16 @@ class RegisterResponse400:
     error = "User with this username already exists"
 
 
+# Check username
+class CheckUsernameResponse200:
+    username = "username"
+    available = True
+
+
+class CheckUsernameResponse400:
+    error = "username length must be between 1 and 64 characters"
+
+
 class ActivateUserResponse200:
     message = "Logged in successfully"
     token = "jwt"
@@ -34,6 +44,17 @@ class LoginResponse401:
     error = "The username or password is entered incorrectly"
 
 
+# Hashing queue is full status_code=503
+class ServiceUnavailableResponse503:
+    error = "The server is busy, try again later"
+
+
+# Token refresh
+class RefreshTokenResponse200:
+    message = "The token was successfully refreshed"
+    token = "jwt"
+
+
 # Unauthorized Error status_code=401
 class UnauthorizedResponse401:
     error = "Login to your account to use this functionality"
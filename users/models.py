@@ -19,6 +19,12 @@ class UserVerification(Base):
 
     uuid = sa.Column(UUID(as_uuid=True), primary_key=True)
     user_id = sa.Column(sa.ForeignKey("users.id"), nullable=False)
+    created_at = sa.Column(
+        sa.types.DateTime,
+        server_default=sa.func.now(),
+        nullable=False,
+        index=True,
+    )
 
     __table_args__ = (
         sa.UniqueConstraint("user_id", "uuid", name="_fk_user_uuid_uc"),
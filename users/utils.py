@@ -1,40 +1,300 @@
+import asyncio
 import binascii
 import hashlib
+import hmac
 import os
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import NamedTuple, Optional
 from uuid import UUID
 
 from databases import Database
+from redis.asyncio import Redis
+from sanic.log import logger
 
-from users.models import user_verification, users
+import settings
+from cache import BloomFilter, TTLCache, on_invalidation, publish_invalidation
+from metrics import register_metric
+from users.models import users
 
+PASSWORD_HASH_ALGORITHM = "pbkdf2_sha512"
+# Cost of the hashes stored as 64 chars of salt followed by the hash
+LEGACY_HASH_ITERATIONS = 100000
 
-def generate_hash(password):
-    salt = hashlib.sha256(os.urandom(60)).hexdigest().encode("ascii")
+_hash_executor = None
+
+
+class Principal(NamedTuple):
+    id: int
+    username: str
+    is_active: bool
+    is_admin: bool
+
+
+principal_cache = TTLCache(
+    settings.PRINCIPAL_CACHE_SIZE, settings.PRINCIPAL_CACHE_TTL
+)
+register_metric("principal_cache", principal_cache.stats)
+
+
+@on_invalidation(settings.USER_INVALIDATION_CHANNEL)
+def _invalidate_cached_principal(message: dict):
+    principal_cache.pop(message["user_id"])
+
+
+class UsernameFilter:
+    """Bloom filter of taken usernames, until it is built every username
+    is reported as possibly taken"""
+
+    def __init__(self):
+        self.bloom = None
+        # Usernames added while a rebuild reads the users table
+        self._added_during_rebuild = None
+
+    def might_be_taken(self, username: str) -> bool:
+        return self.bloom is None or username in self.bloom
+
+    def add(self, username: str):
+        if self.bloom is not None:
+            self.bloom.add(username)
+        if self._added_during_rebuild is not None:
+            self._added_during_rebuild.append(username)
+
+    def start_rebuild(self):
+        self._added_during_rebuild = []
+
+    def finish_rebuild(self, bloom: Optional[BloomFilter]):
+        """Replace the filter, keeping the usernames added meanwhile"""
+        added, self._added_during_rebuild = self._added_during_rebuild, None
+        if bloom is not None:
+            for username in added or ():
+                bloom.add(username)
+            self.bloom = bloom
+
+    def stats(self) -> dict:
+        if self.bloom is None:
+            return {"ready": False}
+        return {"ready": True, **self.bloom.stats()}
+
+
+username_filter = UsernameFilter()
+register_metric("username_filter", username_filter.stats)
+
+
+@on_invalidation(settings.USERNAME_FILTER_CHANNEL)
+def _add_taken_username(message: dict):
+    username_filter.add(message["username"])
+
+
+def generate_hash(password, iterations=None):
+    """Return "algorithm$iterations$salt$hash" of the password"""
+    iterations = iterations or settings.PASSWORD_HASH_ITERATIONS
+    salt = hashlib.sha256(os.urandom(60)).hexdigest()
     pwdhash = hashlib.pbkdf2_hmac(
-        "sha512", password.encode("utf-8"), salt, 100000
+        "sha512", password.encode("utf-8"), salt.encode("ascii"), iterations
     )
-    pwdhash = binascii.hexlify(pwdhash)
-    return (salt + pwdhash).decode("ascii")
+    pwdhash = binascii.hexlify(pwdhash).decode("ascii")
+    return f"{PASSWORD_HASH_ALGORITHM}${iterations}${salt}${pwdhash}"
+
+
+def _parse_hash(stored_password):
+    """Return iterations, salt and hash of a stored password"""
+    if "$" not in stored_password:
+        return (
+            LEGACY_HASH_ITERATIONS,
+            stored_password[:64],
+            stored_password[64:],
+        )
+
+    algorithm, iterations, salt, pwdhash = stored_password.split("$")
+    if algorithm != PASSWORD_HASH_ALGORITHM:
+        raise ValueError(f"Unsupported password hash algorithm {algorithm}")
+    return int(iterations), salt, pwdhash
 
 
 def verify_hash(stored_password, password):
-    salt = stored_password[:64]
-    stored_password = stored_password[64:]
+    iterations, salt, stored_hash = _parse_hash(stored_password)
     pwdhash = hashlib.pbkdf2_hmac(
-        "sha512", password.encode("utf-8"), salt.encode("ascii"), 100000
+        "sha512", password.encode("utf-8"), salt.encode("ascii"), iterations
     )
     pwdhash = binascii.hexlify(pwdhash).decode("ascii")
-    return pwdhash == stored_password
+    return hmac.compare_digest(pwdhash, stored_hash)
+
+
+def needs_rehash(stored_password):
+    """Check if the hash was made with outdated parameters"""
+    if "$" not in stored_password:
+        return True
+    iterations, _, _ = _parse_hash(stored_password)
+    return iterations != settings.PASSWORD_HASH_ITERATIONS
+
+
+class HashingOverloaded(Exception):
+    """The hashing queue is full, the request should be retried later"""
+
+
+class AdmissionLimiter:
+    """Allow `concurrency` jobs to run and `queue_size` to wait for a slot,
+    reject the others right away instead of letting them pile up"""
+
+    def __init__(self, concurrency: int, queue_size: int):
+        self.concurrency = concurrency
+        self.queue_size = queue_size
+        self.running = 0
+        self.waiting = 0
+        self.rejected = 0
+        self._semaphore = asyncio.BoundedSemaphore(concurrency)
+
+    async def __aenter__(self):
+        if self._semaphore.locked() and self.waiting >= self.queue_size:
+            self.rejected += 1
+            raise HashingOverloaded
+        self.waiting += 1
+        try:
+            await self._semaphore.acquire()
+        finally:
+            self.waiting -= 1
+        self.running += 1
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self.running -= 1
+        self._semaphore.release()
+
+    def stats(self) -> dict:
+        return {
+            "concurrency": self.concurrency,
+            "queue_size": self.queue_size,
+            "running": self.running,
+            "queue_depth": self.waiting,
+            "rejected": self.rejected,
+        }
+
+
+hash_limiter = AdmissionLimiter(
+    settings.HASH_CONCURRENCY, settings.HASH_QUEUE_SIZE
+)
+register_metric("hash_admission", hash_limiter.stats)
+
+
+def generate_token_digest(token):
+    """Keyed digest for random session tokens, they don't need PBKDF2"""
+    return hmac.new(
+        settings.TOKEN_HMAC_KEY.encode("utf-8"),
+        token.encode("utf-8"),
+        hashlib.sha256,
+    ).hexdigest()
+
+
+def verify_token_digest(token_digest, token):
+    return hmac.compare_digest(token_digest, generate_token_digest(token))
+
+
+def _create_hash_executor(executor_type: str):
+    workers = settings.PASSWORD_HASH_WORKERS or None
+    if executor_type == "process":
+        try:
+            return ProcessPoolExecutor(max_workers=workers)
+        except (OSError, NotImplementedError):
+            # Platforms without working multiprocessing primitives
+            pass
+    # hashlib.pbkdf2_hmac releases the GIL, so threads still keep
+    # the event loop responsive
+    return ThreadPoolExecutor(
+        max_workers=workers, thread_name_prefix="password-hash"
+    )
+
+
+def get_hash_executor():
+    """Return the pool for password hashing, create it on first use"""
+    global _hash_executor
+    if _hash_executor is None:
+        _hash_executor = _create_hash_executor(
+            settings.PASSWORD_HASH_EXECUTOR
+        )
+    return _hash_executor
+
+
+def shutdown_hash_executor():
+    global _hash_executor
+    if _hash_executor is not None:
+        _hash_executor.shutdown(wait=False, cancel_futures=True)
+        _hash_executor = None
+
+
+async def _run_in_hash_executor(func, *args):
+    global _hash_executor
+    loop = asyncio.get_running_loop()
+    try:
+        return await loop.run_in_executor(get_hash_executor(), func, *args)
+    except BrokenProcessPool:
+        _hash_executor = _create_hash_executor("thread")
+        return await loop.run_in_executor(_hash_executor, func, *args)
+
+
+async def async_generate_hash(password):
+    return await _run_in_hash_executor(generate_hash, password)
+
+
+async def async_verify_hash(stored_password, password):
+    return await _run_in_hash_executor(verify_hash, stored_password, password)
 
 
 # User model utils
-async def create_user(database: Database, username: str, password: str) -> int:
+async def create_user(
+    database: Database, username: str, hashed_password: str
+) -> int:
 
     return await database.execute(
         query=users.insert(),
         values={
             "username": username,
-            "hashed_password": generate_hash(password),
+            "hashed_password": hashed_password,
+        },
+    )
+
+
+async def create_user_with_verification(
+    database: Database, username: str, hashed_password: str, uuid: UUID
+) -> int:
+    """Insert the user and the activation link in one round trip"""
+    query = """
+               WITH new_user AS (
+                   INSERT INTO users(username, hashed_password)
+                   VALUES (:username, :hashed_password)
+                   RETURNING id
+               )
+               INSERT INTO user_verification(uuid, user_id)
+               SELECT CAST(:uuid AS uuid), id FROM new_user
+               RETURNING user_id
+            """
+    return await database.fetch_val(
+        query=query,
+        values={
+            "username": username,
+            "hashed_password": hashed_password,
+            "uuid": uuid,
+        },
+    )
+
+
+async def update_password_hash(
+    database: Database, user_id: int, password: str
+):
+    """Rehash with the current parameters, skipped when hashing is
+    overloaded, the next login of the user retries it"""
+    try:
+        async with hash_limiter:
+            hashed_password = await async_generate_hash(password)
+    except HashingOverloaded:
+        return None
+
+    query = "UPDATE users SET hashed_password = :hashed_password WHERE id = :user_id"
+    return await database.execute(
+        query=query,
+        values={
+            "user_id": user_id,
+            "hashed_password": hashed_password,
         },
     )
 
@@ -59,60 +319,175 @@ async def get_user_by_username(database: Database, username: str):
     )
 
 
+async def is_username_taken(database: Database, username: str) -> bool:
+    query = "SELECT EXISTS(SELECT 1 FROM users WHERE username = :username)"
+    return await database.fetch_val(
+        query=query, values={"username": username}
+    )
+
+
+USERNAME_FILTER_BATCH_SIZE = 10000
+
+
+async def build_username_filter(database: Database) -> BloomFilter:
+    count = await database.fetch_val("SELECT count(*) FROM users")
+    bloom = BloomFilter(
+        max(settings.USERNAME_FILTER_CAPACITY, count * 2),
+        settings.USERNAME_FILTER_ERROR_RATE,
+    )
+    # Chunks instead of a cursor: cancelling the rebuild between awaits
+    # doesn't leave a pooled connection checked out
+    query = """
+               SELECT id, username FROM users
+               WHERE id > :after
+               ORDER BY id
+               LIMIT :limit
+            """
+    after = 0
+    while True:
+        rows = await database.fetch_all(
+            query=query,
+            values={"after": after, "limit": USERNAME_FILTER_BATCH_SIZE},
+        )
+        for user in rows:
+            bloom.add(user["username"])
+        if len(rows) < USERNAME_FILTER_BATCH_SIZE:
+            return bloom
+        after = rows[-1]["id"]
+
+
+async def refresh_username_filter(app):
+    """Rebuild the filter to pick up registrations whose message was lost"""
+    while True:
+        bloom = None
+        username_filter.start_rebuild()
+        try:
+            bloom = await build_username_filter(app.config["database"])
+        except Exception:
+            logger.exception("Can't build the username filter")
+        finally:
+            username_filter.finish_rebuild(bloom)
+        await asyncio.sleep(settings.USERNAME_FILTER_REBUILD_INTERVAL)
+
+
+async def add_taken_username(conn: Redis, username: str):
+    """Add the username to the filter of every worker"""
+    await publish_invalidation(
+        conn, settings.USERNAME_FILTER_CHANNEL, {"username": username}
+    )
+
+
 async def get_users_and_bills(database: Database):
     query = "SELECT * FROM users WHERE username = :username"
     return await database.execute(query=query)
 
 
-async def is_user_admin(database: Database, user_id: int):
-    query = "SELECT * FROM users WHERE id = :user_id AND is_admin = true AND is_active = true"
-    return await database.fetch_one(query=query, values={"user_id": user_id})
+async def get_principal(
+    database: Database, user_id: int
+) -> Optional[Principal]:
+    """Return the fields the auth decorators need, cached for a few seconds"""
+    principal = principal_cache.get(user_id)
+    if principal is None:
+        query = "SELECT id, username, is_active, is_admin FROM users WHERE id = :user_id"
+        user = await database.fetch_one(
+            query=query, values={"user_id": user_id}
+        )
+        if not user:
+            return None
+        principal = Principal(
+            user["id"], user["username"], user["is_active"], user["is_admin"]
+        )
+        principal_cache.set(user_id, principal)
+    return principal
 
 
-async def is_user_active(database: Database, user_id: int):
-    query = "SELECT * FROM users WHERE id = :user_id AND is_active = true"
-    return await database.fetch_one(query=query, values={"user_id": user_id})
+async def invalidate_principal(conn: Redis, user_id: int):
+    """Drop the cached principal in every worker"""
+    await publish_invalidation(
+        conn, settings.USER_INVALIDATION_CHANNEL, {"user_id": user_id}
+    )
 
 
 async def activate_user(database, user_id: int):
     query = "UPDATE users SET is_active = True WHERE id = :user_id"
-    return await database.execute(
+    result = await database.execute(
         query=query,
         values={
             "user_id": user_id,
         },
     )
+    principal_cache.pop(user_id)
+    return result
 
 
 async def change_user_activity(database, user_id: int, is_active: bool):
     query = "UPDATE users SET is_active = :is_active WHERE id = :user_id"
-    return await database.execute(
+    result = await database.execute(
         query=query, values={"user_id": user_id, "is_active": is_active}
     )
+    principal_cache.pop(user_id)
+    return result
 
 
 # UserVerification model utils
-async def create_user_verification(
+async def consume_user_verification(
     database: Database, uuid: UUID, user_id: int
-):
+) -> bool:
+    """Delete the activation link, return True if it existed and was fresh"""
+    query = """
+               DELETE FROM user_verification
+               WHERE uuid = :uuid AND user_id = :user_id
+               RETURNING created_at > NOW() - make_interval(secs => :ttl)
+            """
+    return bool(
+        await database.fetch_val(
+            query=query,
+            values={
+                "uuid": uuid,
+                "user_id": user_id,
+                "ttl": settings.ACTIVATION_TOKEN_TTL,
+            },
+        )
+    )
 
-    return await database.execute(
-        query=user_verification.insert(),
-        values={
-            "uuid": uuid,
-            "user_id": user_id,
-        },
+
+async def delete_stale_user_verifications(database: Database) -> None:
+    query = "DELETE FROM user_verification WHERE created_at < NOW() - make_interval(secs => :ttl)"
+    await database.execute(
+        query=query, values={"ttl": settings.ACTIVATION_TOKEN_TTL}
     )
 
 
-async def filter_by_user_verification(
-    database: Database, uuid: UUID, user_id: int
-):
-    query = "SELECT * FROM user_verification WHERE uuid = :uuid AND user_id = :user_id"
-    return await database.execute(
-        query=query,
-        values={
-            "uuid": uuid,
-            "user_id": user_id,
-        },
+async def cleanup_user_verifications(app):
+    """Periodically delete the activation links nobody followed"""
+    while True:
+        await asyncio.sleep(settings.VERIFICATION_CLEANUP_INTERVAL)
+        try:
+            await delete_stale_user_verifications(app.config["database"])
+        except Exception:
+            logger.exception("Can't delete stale user verifications")
+
+
+# Activation links stored in redis
+async def create_activation_token(conn: Redis, uuid: UUID, user_id: int):
+    await conn.set(
+        f"activation_{uuid}", user_id, ex=settings.ACTIVATION_TOKEN_TTL
+    )
+
+
+# Compare and delete in one step, so a token is consumed only once
+_CONSUME_ACTIVATION_TOKEN = """
+if redis.call("GET", KEYS[1]) == ARGV[1] then
+    return redis.call("DEL", KEYS[1])
+end
+return 0
+"""
+
+
+async def consume_activation_token(
+    conn: Redis, uuid: UUID, user_id: int
+) -> bool:
+    deleted = await conn.eval(
+        _CONSUME_ACTIVATION_TOKEN, 1, f"activation_{uuid}", str(user_id)
     )
+    return deleted == 1
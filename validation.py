@@ -0,0 +1,18 @@
+from typing import Tuple
+
+from cerberus import Validator
+
+# Bounds of the INTEGER columns, larger values fail in postgres
+INT32_MAX = 2147483647
+
+
+def validate_bulk_items(items: list, schema: dict) -> Tuple[list, dict]:
+    """Return indexes of the valid items and {index: errors} of the rest"""
+    validator = Validator(schema)
+    valid, errors = [], {}
+    for index, item in enumerate(items):
+        if validator.validate(item):
+            valid.append(index)
+        else:
+            errors[index] = validator.errors
+    return valid, errors